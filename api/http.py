@@ -1,44 +1,102 @@
-import asyncio
 import logging
+from email.utils import formatdate, parsedate_to_datetime
 from typing import Optional
+from uuid import UUID
 
 import fastapi
-from fastapi.responses import Response
+from fastapi.responses import FileResponse, Response
+from starlette.datastructures import FormData
+from starlette.formparsers import MultiPartException, MultiPartParser
 
+from managers.backplane import WorkerLoader
 from managers.base import BaseLoader
-from managers.data import Submission
-from managers.problems import Problem
+from managers.queue import QueueFullError
+from managers.ratelimit import RateLimitError
 from utils import auth
-from utils.enums import ContestProgress, SubmissionStatus
+from utils.enums import ContestProgress
 
 logger = logging.getLogger(__name__)
 
+MAX_PAGE_SIZE = 500
+# Room for the boundaries, headers and the other fields of the submission form
+FORM_OVERHEAD = 16 * 1024
+
+
+class UploadTooLarge(MultiPartException):
+    def __init__(self):
+        super().__init__("Upload too large")
+
+
+async def __read_form__(request: fastapi.Request, limit: int) -> FormData:
+    # Parsed while it arrives, the upload is aborted as soon as it gets larger than the limit
+    length = request.headers.get("Content-Length", None)
+    if length is not None and length.isdigit() and int(length) > limit:
+        raise UploadTooLarge()
+    
+    async def stream():
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > limit:
+                raise UploadTooLarge()
+            yield chunk
+    
+    return await MultiPartParser(request.headers, stream(), max_files=1, max_fields=8).parse()
+
+
+async def authenticate(request: fastapi.Request) -> Optional[UUID]:
+    # Request dependency, the token is checked once per request and a known one is not verified again.
+    # None when the token is invalid or does not belong to a contestant of the current contest.
+    # Async so it runs on the event loop, next to the state it reads, instead of in the threadpool
+    loader: BaseLoader | WorkerLoader = request.app.state.loader
+    uid = loader.tokens.verify(request.headers.get("Authorization", None))
+    if uid is None or not loader.has_contestant(uid):
+        return None
+    return uid
+
+
+def __unauthorized__() -> fastapi.Response:
+    return fastapi.Response(status_code=401, content="Unauthorized")
+
+
+class ContentResponse(FileResponse):
+    # Starlette only honours If-Range with its own ETag, compare with the one actually sent
+    def _should_use_range(self, http_if_range: str, stat_result) -> bool:
+        return http_if_range in (self.headers.get("etag", None), self.headers.get("last-modified", None))
+
+
+def __not_modified__(request: fastapi.Request, etag: str, modified: float) -> bool:
+    # If-None-Match wins over If-Modified-Since, as in RFC 9110
+    if_none_match = request.headers.get("If-None-Match", None)
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("If-Modified-Since", None)
+    if if_modified_since is None:
+        return False
+    try:
+        return int(modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+
 
 class ContestantRouter(fastapi.APIRouter):
-    def __init__(self, base: BaseLoader):
+    def __init__(self, base: BaseLoader | WorkerLoader):
         self.base = base
         super().__init__()
         
         # Register the routes
         self.add_api_route("/add", self.add_contestant, methods=["POST"])
         self.add_api_route("/problems", self.get_problems_list, methods=["GET"])
-        self.add_api_route("/content/{name:path}.pdf", self.get_content, methods=["GET"])
+        self.add_api_route("/content/{name:path}.pdf", self.get_content, methods=["GET", "HEAD"])
         self.add_api_route("/submit", self.submit, methods=["POST"])
         self.add_api_route("/restore", self.restore, methods=["GET"])
+        self.add_api_route("/scoreboard", self.get_scoreboard, methods=["GET"])
         self.add_api_route("/finish", self.finish, methods=["POST"])
         
     
-    def __authorize__(self, request: fastapi.Request) -> Optional[fastapi.Response]:
-        verification = auth.verify_token(request.headers.get("Authorization", None))
-        if verification is None or verification not in self.base.contest.contestants:
-            return fastapi.Response(status_code=401, content="Unauthorized")
-        if not self.base.contest:
-            return fastapi.Response(status_code=500, content="Internal server error")
-        return None
-        
-        
     async def add_contestant(self, request: fastapi.Request):
-        if self.base.contest.progress is not ContestProgress.NOT_STARTED:
+        if self.base.progress is not ContestProgress.NOT_STARTED:
             return fastapi.Response(status_code=400, content="Contest already started")
         try:
             data = await request.json()
@@ -49,7 +107,7 @@ class ContestantRouter(fastapi.APIRouter):
         except:
             return fastapi.Response(status_code=400, content="Bad request")
         
-        uid = self.base.contest.add_contestant(name, color)
+        uid = await self.base.add_contestant(name, color)
         token = auth.generate_token(uid)
         return fastapi.responses.JSONResponse(
             status_code=200,
@@ -62,132 +120,108 @@ class ContestantRouter(fastapi.APIRouter):
         )
     
     
-    async def get_problems_list(self, request: fastapi.Request):
-        _auth = self.__authorize__(request)
-        if _auth is not None:
-            return _auth
-        if self.base.contest.progress is not ContestProgress.IN_PROGRESS:
+    async def get_problems_list(self, request: fastapi.Request, uid: Optional[UUID] = fastapi.Depends(authenticate)):
+        if uid is None:
+            return __unauthorized__()
+        if self.base.progress is not ContestProgress.IN_PROGRESS:
             return fastapi.Response(status_code=400, content="Contest is not in progress")
         return fastapi.responses.JSONResponse(
             status_code=200,
-            content=[entry.name for entry in self.base.contest.problems]
+            content=self.base.problem_names()
         )
     
     
-    def __find_problem__(self, name: str) -> Optional[Problem]:
-        for problem in self.base.contest.problems:
-            if problem.name == name:
-                return problem
-        return None
-    
-    
-    async def get_content(self, name: str):
-        if self.base.contest.progress is not ContestProgress.IN_PROGRESS:
+    async def get_content(self, name: str, request: fastapi.Request):
+        if self.base.progress is not ContestProgress.IN_PROGRESS:
             return fastapi.Response(status_code=400, content="Contest is not in progress")
-        target = self.__find_problem__(name)
+        target = self.base.get_problem(name)
         if target is None:
             return fastapi.Response(status_code=404, content="Problem not found")
-        return Response(
-            content=target.content,
-            headers={
-                "Content-Type": "application/pdf"
-            }
-        )
+        headers = {
+            "ETag": target.etag,
+            "Last-Modified": formatdate(target.stat.st_mtime, usegmt=True),
+            # Cacheable by the browsers and a proxy in front, but always revalidated in case the statement is fixed
+            "Cache-Control": "public, no-cache"
+        }
+        if __not_modified__(request, target.etag, target.stat.st_mtime):
+            return Response(status_code=304, headers=headers)
+        # Streamed from the file, with Range and If-Range handled by Starlette
+        return ContentResponse(target.path, headers=headers, media_type="application/pdf", stat_result=target.stat)
     
-    async def submit(self, request: fastapi.Request):
-        _auth = self.__authorize__(request)
-        if _auth is not None:
-            return _auth
-        if self.base.contest.progress is not ContestProgress.IN_PROGRESS:
+    async def submit(self, request: fastapi.Request, uid: Optional[UUID] = fastapi.Depends(authenticate)):
+        if uid is None:
+            return __unauthorized__()
+        if self.base.progress is not ContestProgress.IN_PROGRESS:
             return fastapi.Response(status_code=400, content="Contest is not in progress")
+        max_source = self.base.limiter.max_source
         try:
-            uid = auth.verify_token(request.headers.get("Authorization", None))
-            contestant = self.base.contest.contestants[uid]
-            data = await request.form()
-            problem: str = data.get("problem", None)
-            language: str = data.get("language", None)
-            code: bytes = await data.get("code", None).read()
+            # Rejected before the upload is read, the contest process checks again before queueing
+            self.base.limiter.check(uid)
+            data = await __read_form__(request, max_source + FORM_OVERHEAD)
+            try:
+                problem: str = data.get("problem", None)
+                language: str = data.get("language", None)
+                code: bytes = await data.get("code", None).read(max_source + 1)
+            finally:
+                await data.close()
             if not isinstance(problem, str) or not isinstance(language, str) or not isinstance(code, bytes):
                 raise ValueError("Request does not match the expected format")
-            if contestant.state.get(problem, None) is SubmissionStatus.ACCEPTED:
+            if len(code) > max_source:
+                raise UploadTooLarge()
+            result = await self.base.submit(uid, problem, language, code)
+            if result is None:
                 return fastapi.Response(status_code=400, content="You already solved this problem")
-            submission = Submission(
-                contestant_id=contestant.id,
-                problem=problem,
-                language=language,
-                time=self.base.contest.elapsed,
-                code=code
+            return fastapi.responses.JSONResponse(status_code=200, content=result)
+        except UploadTooLarge:
+            return fastapi.Response(status_code=413, content=f"Source code is larger than {max_source // 1024} KiB")
+        except (QueueFullError, RateLimitError) as e:
+            logger.warning(f"Rejected submission: {e}")
+            return fastapi.Response(
+                status_code=429 if e.per_contestant else 503,
+                content=f"{e}, please try again in {e.retry_after} seconds",
+                headers={"Retry-After": str(e.retry_after)}
             )
-            asyncio.create_task(self.base.sandbox_manager.submit(submission, self.base.contest.submission_callback))
-            return fastapi.responses.JSONResponse(status_code=200, content={
-                "id": str(submission.id),
-                "problem": submission.problem,
-                "language": submission.language,
-                "result": submission.status.name,
-                "time": submission.time
-            })
         except Exception as e:
             logger.error(f"Failed to submit: {e}")
             return fastapi.Response(status_code=400, content="Bad request")
         
         
-    async def restore(self, request: fastapi.Request):
-        _auth = self.__authorize__(request)
-        if _auth is not None:
-            return _auth
+    async def restore(self, request: fastapi.Request, uid: Optional[UUID] = fastapi.Depends(authenticate)):
+        if uid is None:
+            return __unauthorized__()
         try:
-            uid = auth.verify_token(request.headers.get("Authorization", None))
-            contestant = self.base.contest.contestants[uid]
-            progress = self.base.contest.progress
-            if contestant.finished > 0 and self.base.contest.progress is ContestProgress.IN_PROGRESS:
-                progress = ContestProgress.FINISHED
-            data = {
-                "uid": str(uid),
-                "name": contestant.name,
-                "contest_progress": progress.name,
-                "contestants": []
+            etag, body, (left, cooldown) = await self.base.restore(uid, request.headers.get("If-None-Match", None))
+            headers = {
+                "ETag": etag,
+                "Cache-Control": "private, no-cache",
+                "Vary": "Authorization",
+                # Not part of the body, which stays the same while the timer runs
+                "X-Contest-Elapsed": str(self.base.elapsed)
             }
-            for c in self.base.contest.contestants.values():
-                data["contestants"].append({
-                    "uid": str(c.id),
-                    "name": c.name,
-                    "color": c.color,
-                    "score": c.score,
-                    "progress": {problem: status.name for problem, status in c.state.items()},
-                    "finished": c.finished
-                })
-            if contestant.color is not None:
-                data["color"] = contestant.color
-            if progress is ContestProgress.IN_PROGRESS:
-                data["contest"] = {
-                    "duration": self.base.contest.duration,
-                    "elapsed": self.base.contest.elapsed,
-                    "problems": [problem.name for problem in self.base.contest.problems],
-                    "supported_languages": self.base.contest.supported_languages
-                }
-                data["submissions"] = []
-                for submission in contestant.submissions:
-                    data["submissions"].append({
-                        "id": str(submission.id),
-                        "problem": submission.problem,
-                        "language": submission.language,
-                        "result": submission.status.name,
-                        "time": submission.time
-                    })
-            logger.info(f"Restored session for {contestant.name}")
-            return fastapi.responses.JSONResponse(status_code=200, content=data)
+            if left >= 0:
+                # Submissions the contestant can make now, and the seconds until the next one
+                headers["X-Submissions-Left"] = str(left)
+                headers["X-Submission-Cooldown"] = str(cooldown)
+            if body is None:
+                return fastapi.Response(status_code=304, headers=headers)
+            return fastapi.Response(status_code=200, content=body, media_type="application/json", headers=headers)
         except Exception as e:
             logger.error(f"Failed to restore session: {e}")
             return fastapi.Response(status_code=500, content="Failed to restore session")
     
     
-    async def finish(self, request: fastapi.Request):
-        _auth = self.__authorize__(request)
-        if _auth is not None:
-            return _auth
+    async def get_scoreboard(self, offset: int = 0, limit: int = 50):
+        # Public, in ranking order: {"total": 5000, "offset": 0, "contestants": [{"rank": 1, ...}, ...]}
+        if offset < 0 or not 0 < limit <= MAX_PAGE_SIZE:
+            return fastapi.Response(status_code=400, content="Bad request")
+        return fastapi.responses.JSONResponse(status_code=200, content=self.base.scoreboard_page(offset, limit))
+    
+    
+    async def finish(self, request: fastapi.Request, uid: Optional[UUID] = fastapi.Depends(authenticate)):
+        if uid is None:
+            return __unauthorized__()
         try:
-            uid = auth.verify_token(request.headers.get("Authorization", None))
-            if self.base.contest.mark_finished(uid):
+            if await self.base.finish(uid):
                 return fastapi.Response(status_code=200, content="Success")
             return fastapi.Response(status_code=400, content="Bad request")
         except Exception as e:
@@ -0,0 +1,87 @@
+import json
+
+from utils.enums import ContestProgress, SubmissionStatus
+
+# Compact websocket protocol, requested with /ws?proto=compact. Field names are shortened and the
+# event names and enums are sent as their index in the tables below. The first frame is a plain
+# PROTOCOL message carrying the tables, so the clients never hardcode them
+KEYS = {
+    "event": "e",
+    "seq": "q",
+    "id": "i",
+    "uid": "u",
+    "name": "n",
+    "color": "c",
+    "contestant": "ct",
+    "contestants": "cs",
+    "contest": "cn",
+    "contest_progress": "cp",
+    "problem": "p",
+    "problems": "ps",
+    "language": "l",
+    "supported_languages": "ls",
+    "status": "s",
+    "score": "sc",
+    "rank": "rk",
+    "time": "t",
+    "progress": "pr",
+    "finished": "f",
+    "duration": "d",
+    "elapsed": "el",
+    "message": "m",
+    "testcase": "tc",
+    "total": "tt",
+    "topics": "tp"
+}
+
+EVENTS = [
+    "NEW_CONTESTANT",
+    "CONTEST_STARTED",
+    "CONTEST_STOPPED",
+    "CONTEST_RESET",
+    "CONTESTANT_FINISHED",
+    "SUBMISSION_RESULT",
+    "SUBMISSION_VERDICT",
+    "SUBMISSION_PROGRESS",
+    "SCOREBOARD_DELTA",
+    "SNAPSHOT",
+    "SUBSCRIPTIONS"
+]
+
+STATUSES = [status.name for status in SubmissionStatus]
+PROGRESSES = [progress.name for progress in ContestProgress]
+
+_EVENT_CODES = {name: code for code, name in enumerate(EVENTS)}
+_STATUS_CODES = {name: code for code, name in enumerate(STATUSES)}
+_PROGRESS_CODES = {name: code for code, name in enumerate(PROGRESSES)}
+# Values of these fields are replaced by their code, unknown values are kept as they are
+_VALUE_CODES = {"event": _EVENT_CODES, "status": _STATUS_CODES, "contest_progress": _PROGRESS_CODES}
+
+
+def __compact__(value, key: str = None):
+    if isinstance(value, dict):
+        if key == "progress":
+            # Keyed by problem name, only the statuses are encoded
+            return {problem: _STATUS_CODES.get(status, status) for problem, status in value.items()}
+        return {KEYS.get(k, k): __compact__(v, k) for k, v in value.items()}
+    if isinstance(value, list):
+        return [__compact__(item, key) for item in value]
+    if isinstance(value, str) and key in _VALUE_CODES:
+        return _VALUE_CODES[key].get(value, value)
+    return value
+
+
+def encode(message: dict, compact: bool = False) -> str:
+    if not compact:
+        return json.dumps(message)
+    return json.dumps(__compact__(message), separators=(",", ":"))
+
+
+def handshake() -> str:
+    return json.dumps({
+        "event": "PROTOCOL",
+        "keys": KEYS,
+        "events": EVENTS,
+        "statuses": STATUSES,
+        "progresses": PROGRESSES
+    }, separators=(",", ":"))
@@ -1,45 +1,327 @@
 import asyncio
+import itertools
+import json
 import logging
+import os
+import time
+from collections import deque
+from typing import Optional
+
 from fastapi import WebSocket, WebSocketDisconnect
 
+from api import protocol
+from utils import auth
+from utils.enums import Topic
+
 logger = logging.getLogger(__name__)
 
 
+class Client:
+    def __init__(self, websocket: WebSocket, max_queue: int, drop_oldest: bool, compact: bool = False):
+        self.websocket: WebSocket = websocket
+        self.compact: bool = compact
+        self.max_queue: int = max_queue
+        self.drop_oldest: bool = drop_oldest
+        self.dropped: int = 0
+        # Set when queued events were dropped, the client is owed a snapshot
+        self.resync: bool = False
+        self.closed: bool = False
+        self.topics: set[str] = set()
+        # Set while a frame is being written, a send that never finishes means the peer is gone
+        self.sending_since: Optional[float] = None
+        self.queue: deque[str] = deque()
+        self._pending = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+    
+    
+    def start(self, on_close: callable):
+        self._writer = asyncio.create_task(self.__writer__())
+        self._writer.add_done_callback(lambda _: on_close(self))
+    
+    
+    def push(self, text: str) -> bool:
+        # Never waits for the socket, returns False when the client should be disconnected
+        if self.closed:
+            return False
+        if len(self.queue) >= self.max_queue:
+            if not self.drop_oldest:
+                return False
+            # A gap in the events would leave the client wrong without knowing it, everything queued
+            # is dropped and replaced with a snapshot by the manager
+            self.dropped += len(self.queue) + 1
+            self.queue.clear()
+            self.resync = True
+            return True
+        self.queue.append(text)
+        self._pending.set()
+        return True
+    
+    
+    def send(self, message: dict) -> bool:
+        return self.push(protocol.encode(message, self.compact))
+    
+    
+    async def __writer__(self):
+        try:
+            if self.compact:
+                # Outside the queue, dropping it on an overflow would leave the client unable to decode
+                await self.websocket.send_text(protocol.handshake())
+            while not self.closed:
+                await self._pending.wait()
+                self._pending.clear()
+                while self.queue and not self.closed:
+                    self.sending_since = time.monotonic()
+                    await self.websocket.send_text(self.queue.popleft())
+                    self.sending_since = None
+        except Exception as e:
+            if not isinstance(e, WebSocketDisconnect):
+                logger.error(f"Failed to send message to client: {e}")
+        finally:
+            self.closed = True
+    
+    
+    def close(self, code: Optional[int] = None):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        self._pending.set()
+        if code is not None:
+            asyncio.create_task(self.__close_socket__(code))
+    
+    
+    def abort(self):
+        # For a writer stuck on a dead connection, closing it politely would hang as well
+        self.closed = True
+        self.queue.clear()
+        if self._writer:
+            self._writer.cancel()
+    
+    
+    async def __close_socket__(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+
 class WebSocketManager:
     def __init__(self):
         super().__init__()
-        self.clients: set[WebSocket] = set()
-        self.lock = asyncio.Lock()
+        self.clients: set[Client] = set()
+        # topic -> subscribed clients, events are only pushed to the clients of their topic
+        self.topics: dict[str, set[Client]] = {}
+        self.max_queue: int = int(os.getenv("WS_QUEUE_SIZE", 256))
+        # "drop_oldest" keeps slow clients connected and sends them a snapshot instead of the events they
+        # could not keep up with, "disconnect" closes them
+        self.drop_oldest: bool = os.getenv("WS_OVERFLOW_POLICY", "drop_oldest") != "disconnect"
+        self.overflowed: int = 0
+        # Every event gets a sequence number, the latest ones are kept for replay on reconnect
+        self.seq: int = 0
+        self.history: deque[tuple[int, str, dict]] = deque(maxlen=int(os.getenv("WS_REPLAY_SIZE", 2000)))
+        # Returns the public contest state, sent when the events a client missed are gone
+        self.snapshot: Optional[callable] = None
+        self.replays: int = 0
+        self.snapshots: int = 0
+        self.resyncs: int = 0
+        # Connection limits, 0 disables the per address limit (e.g. behind a reverse proxy)
+        self.max_clients: int = int(os.getenv("WS_MAX_CLIENTS", 10000))
+        self.max_per_ip: int = int(os.getenv("WS_MAX_PER_IP", 0))
+        self.send_timeout: float = float(os.getenv("WS_SEND_TIMEOUT", 30))
+        self.per_ip: dict[str, int] = {}
+        self.connects: int = 0
+        self.disconnects: int = 0
+        self.rejected: int = 0
+        self.reaped: int = 0
+        self._reaper: Optional[asyncio.Task] = None
+    
+    
+    def __snapshot__(self, client: Client):
+        self.snapshots += 1
+        data = self.snapshot() if self.snapshot else {}
+        # A snapshot taken at an older event (from the backplane) is completed with the events after it
+        seq = data.get("seq", self.seq)
+        client.send({"event": "SNAPSHOT", **data, "seq": seq})
+        self.__replay__(client, seq)
+    
+    
+    def __replay__(self, client: Client, since: int) -> bool:
+        if since > self.seq:
+            # Numbered before a restart of the server
+            return False
+        if since == self.seq:
+            return True
+        if not self.history or self.history[0][0] > since + 1:
+            return False
+        admin = Topic.ADMIN in client.topics
+        for _, topic, message in itertools.islice(self.history, since + 1 - self.history[0][0], None):
+            if admin or topic in client.topics:
+                client.send(message)
+        return True
+    
+    
+    def __resync__(self, client: Client):
+        # The snapshot includes the dropped events, those after it are replayed
+        if not client.resync:
+            return
+        client.resync = False
+        self.resyncs += 1
+        self.__snapshot__(client)
+    
+    
+    def __resume__(self, client: Client, since: int):
+        if self.__replay__(client, since):
+            self.replays += 1
+        else:
+            # The gap has been evicted, fall back to the full state
+            self.__snapshot__(client)
+    
+    
+    @staticmethod
+    def __authorize__(topic: str, token: Optional[str]) -> bool:
+        # Admins can read every topic, contestants only their own one
+        if topic == Topic.SCOREBOARD:
+            return True
+        if auth.verify_admin_token(token):
+            return True
+        if topic.startswith(f"{Topic.CONTESTANT}:"):
+            uid = auth.verify_token(token)
+            return uid is not None and topic == f"{Topic.CONTESTANT}:{uid}"
+        return False
+    
+    
+    def subscribe(self, client: Client, topics: list[str], token: Optional[str] = None) -> list[str]:
+        granted = [topic for topic in topics if self.__authorize__(topic, token)]
+        for topic in granted:
+            client.topics.add(topic)
+            self.topics.setdefault(topic, set()).add(client)
+        return granted
+    
+    
+    def unsubscribe(self, client: Client, topics: Optional[list[str]] = None):
+        for topic in list(client.topics) if topics is None else topics:
+            client.topics.discard(topic)
+            subscribers = self.topics.get(topic, None)
+            if subscribers is None:
+                continue
+            subscribers.discard(client)
+            if not subscribers:
+                del self.topics[topic]
+    
+    
+    def __remove__(self, client: Client):
+        self.clients.discard(client)
+        self.unsubscribe(client)
+    
+    
+    def __handle_message__(self, client: Client, text: str):
+        # {"action": "subscribe" | "unsubscribe", "topics": [...], "token": "..."}
+        try:
+            data = json.loads(text)
+            topics = [str(topic) for topic in data.get("topics", [])]
+            if data.get("action", None) == "subscribe":
+                self.subscribe(client, topics, data.get("token", None))
+            elif data.get("action", None) == "unsubscribe":
+                self.unsubscribe(client, topics)
+            else:
+                return
+        except Exception:
+            return
+        client.send({"event": "SUBSCRIPTIONS", "topics": sorted(client.topics)})
+    
+    
+    async def __reap__(self):
+        # Protocol level pings (uvicorn ws_ping_interval) end the connections whose peer is gone,
+        # this catches the clients whose writer is stuck on a send or that were never removed
+        while True:
+            await asyncio.sleep(max(1.0, self.send_timeout / 2))
+            now = time.monotonic()
+            for client in list(self.clients):
+                if client.closed or (client.sending_since and now - client.sending_since > self.send_timeout):
+                    self.reaped += 1
+                    self.__remove__(client)
+                    client.abort()
     
     
     async def endpoint(self, websocket: WebSocket):
+        address = websocket.client.host if websocket.client else ""
+        if len(self.clients) >= self.max_clients or (self.max_per_ip and self.per_ip.get(address, 0) >= self.max_per_ip):
+            self.rejected += 1
+            # Closing before the handshake would reject it with HTTP 403, accept so the client sees 1013 (try again later)
+            await websocket.accept()
+            await websocket.close(code=1013)
+            return
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self.__reap__())
+        self.per_ip[address] = self.per_ip.get(address, 0) + 1
+        try:
+            await self.__serve__(websocket)
+        finally:
+            self.per_ip[address] -= 1
+            if not self.per_ip[address]:
+                del self.per_ip[address]
+    
+    
+    async def __serve__(self, websocket: WebSocket):
         await websocket.accept()
-        async with self.lock:
-            self.clients.add(websocket)
+        compact = websocket.query_params.get("proto", None) == "compact"
+        client = Client(websocket, self.max_queue, self.drop_oldest, compact)
+        # No await from here until the client is registered, so no event can slip in between.
+        # The compact protocol handshake is sent by the writer ahead of the queue
+        topics = websocket.query_params.get("topics", Topic.SCOREBOARD).split(",")
+        self.subscribe(client, topics, websocket.query_params.get("token", None))
         try:
-            while True:
-                # Keeps the connection open for incoming messages
-                await websocket.receive_text()
-                await asyncio.sleep(1)
+            if "since" in websocket.query_params:
+                self.__resume__(client, int(websocket.query_params["since"]))
+            elif websocket.query_params.get("snapshot", None) == "1":
+                self.__snapshot__(client)
+        except ValueError:
+            pass
+        # A long replay may not fit the queue
+        self.__resync__(client)
+        self.clients.add(client)
+        self.connects += 1
+        client.start(self.__remove__)
+        try:
+            while not client.closed:
+                self.__handle_message__(client, await websocket.receive_text())
         except WebSocketDisconnect:
-            async with self.lock:
-                self.clients.remove(websocket)
             logger.info("Client disconnected")
         except Exception as e:
             logger.error(f"Unexpected error in WebSocket connection: {e}")
+        finally:
+            self.disconnects += 1
+            self.__remove__(client)
+            client.close()
     
     
-    async def broadcast(self, message: dict):
-        async with self.lock:
-            to_disconnect = []
-            for client in list(self.clients):
-                try:
-                    await client.send_json(message)
-                except WebSocketDisconnect:
-                    to_disconnect.append(client)
-                except Exception as e:
-                    logger.error(f"Failed to send message to client: {e}")
-                    
-            # Remove all clients that disconnected during the broadcast attempt
-            for client in to_disconnect:
-                self.clients.remove(client)
+    def clear_history(self):
+        # Events of a previous contest must not be replayed into the next one
+        self.history.clear()
+    
+    
+    def broadcast(self, message: dict, topic: str = Topic.SCOREBOARD):
+        self.seq += 1
+        message["seq"] = self.seq
+        self.relay(message, topic)
+    
+    
+    def relay(self, message: dict, topic: str):
+        # Events numbered by the contest process keep their sequence number, so clients can resume on any worker.
+        # Serialized once per protocol, every subscriber gets the same frame through its own queue
+        self.seq = message["seq"]
+        self.history.append((self.seq, topic, message))
+        recipients = list(self.topics.get(topic, ()))
+        if topic != Topic.ADMIN:
+            recipients.extend(c for c in self.topics.get(Topic.ADMIN, ()) if topic not in c.topics)
+        frames = {}
+        for client in recipients:
+            if client.compact not in frames:
+                frames[client.compact] = protocol.encode(message, client.compact)
+            if not client.push(frames[client.compact]):
+                self.overflowed += 1
+                self.__remove__(client)
+                client.close(code=1008)
+                logger.warning("Disconnected a client that could not keep up with the events")
+            elif client.resync:
+                self.__resync__(client)
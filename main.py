@@ -1,14 +1,57 @@
 from fastapi.staticfiles import StaticFiles
+import asyncio
+import multiprocessing
 import os
 
 import uvicorn
 from dotenv import load_dotenv
 
 from api.http import ContestantRouter
+from managers.backplane import Backplane, WorkerLoader
 from managers.base import BaseLoader
 from utils import console
 
 
+def create_worker():
+    # Application factory of the worker processes in multi-worker mode
+    console.setup()
+    load_dotenv()
+    loader = WorkerLoader(os.getenv("BACKPLANE_SOCKET", ".backplane.sock"))
+    loader.server.mount("/ui", StaticFiles(directory="web", html=True))
+    loader.server.mount("/api", ContestantRouter(loader))
+    return loader.server
+
+
+def serve_workers(workers: int):
+    load_dotenv()
+    uvicorn.run(
+        "main:create_worker",
+        factory=True,
+        workers=workers,
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 8080)),
+        loop="asyncio",
+        ws_per_message_deflate=os.getenv("WS_DEFLATE", "1") == "1",
+        ws_ping_interval=float(os.getenv("WS_PING_INTERVAL", 20)),
+        ws_ping_timeout=float(os.getenv("WS_PING_TIMEOUT", 20)),
+        log_config=None
+    )
+
+
+async def run_core(base: BaseLoader, workers: int):
+    # The contest process owns all the state and only talks to the workers through the backplane
+    backplane = Backplane(base, os.getenv("BACKPLANE_SOCKET", ".backplane.sock"))
+    await backplane.start()
+    await base.startup()
+    process = multiprocessing.get_context("spawn").Process(target=serve_workers, args=(workers,))
+    process.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        process.terminate()
+        base.shutdown()
+
+
 if __name__ == "__main__":
     # Print the logo
     print("""
@@ -26,6 +69,13 @@ __  __            __
     console.setup()
     load_dotenv()
     base = BaseLoader()
+    workers = int(os.getenv("WORKERS", 1))
+    if workers > 1:
+        try:
+            asyncio.run(run_core(base, workers))
+        except KeyboardInterrupt:
+            pass
+        exit(0)
     base.server.mount("/ui", StaticFiles(directory="web", html=True))
     base.server.mount("/api", ContestantRouter(base))
     uvicorn.run(
@@ -33,6 +83,9 @@ __  __            __
         host="0.0.0.0",
         port=os.getenv("PORT", 8080),
         loop="asyncio",
+        ws_per_message_deflate=os.getenv("WS_DEFLATE", "1") == "1",
+        ws_ping_interval=float(os.getenv("WS_PING_INTERVAL", 20)),
+        ws_ping_timeout=float(os.getenv("WS_PING_TIMEOUT", 20)),
         log_config=None
     )
     
\ No newline at end of file
@@ -0,0 +1,375 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import pickle
+import struct
+import time
+import zlib
+from typing import Optional
+from uuid import UUID
+
+import fastapi
+from fastapi import FastAPI
+
+from api.ws import WebSocketManager
+from managers.base import BaseLoader, root, favicon
+from managers.problems import ProblemManager, Problem
+from managers.queue import QueueFullError
+from managers.ratelimit import RateLimitError, SubmissionLimiter
+from managers.watcher import ProblemWatcher
+from utils import auth
+from utils.enums import ContestProgress, Topic
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct("!I")
+# Methods of BaseLoader the workers may call
+CALLS = ("state", "add_contestant", "submit", "contestant_state", "finish")
+# The public snapshot kept by the workers is refreshed at most this often
+SNAPSHOT_INTERVAL = 0.5
+# Events changing the shape of the snapshot, it is pushed right after them. A restore must not pair the
+# contest state of the contest process with the snapshot from before the change
+STRUCTURAL_EVENTS = ("NEW_CONTESTANT", "CONTEST_STARTED", "CONTEST_STOPPED", "CONTEST_RESET")
+
+
+def __frame__(item) -> bytes:
+    # Pickle is fine here, the socket is only reachable by the user running the server
+    data = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(len(data)) + data
+
+
+async def __read_frame__(reader: asyncio.StreamReader):
+    size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return pickle.loads(await reader.readexactly(size))
+
+
+# Runs in the contest process. Workers connect over a Unix socket, call the contest methods of
+# BaseLoader and receive every event, already numbered, to fan out to their own websocket clients:
+#   worker -> core  ("call", <id>, <method>, <args>)
+#   core -> worker  ("result", <id>, <value>) | ("error", <id>, <kind>, <args>)
+#                   ("event", <topic>, <message>) | ("snapshot", <public state>)
+#                   ("bucket", <uid>, <rate limit bucket>)
+class Backplane:
+    def __init__(self, base: BaseLoader, path: str):
+        self.base: BaseLoader = base
+        self.path: str = path
+        self.workers: set[asyncio.StreamWriter] = set()
+        self.calls: int = 0
+        self.events: int = 0
+        self._snapshot: Optional[asyncio.TimerHandle] = None
+        base.on_publish = self.publish
+    
+    
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        await asyncio.start_unix_server(self.__handle__, self.path)
+        os.chmod(self.path, 0o600)
+        logger.info(f"Backplane listening on {self.path}")
+    
+    
+    def __send__(self, item):
+        frame = __frame__(item)
+        for writer in list(self.workers):
+            if writer.is_closing():
+                self.workers.discard(writer)
+                continue
+            writer.write(frame)
+    
+    
+    def publish(self, message: dict, topic: str):
+        self.events += 1
+        self.__send__(("event", topic, message))
+        if message.get("event", None) in STRUCTURAL_EVENTS:
+            # Written before any reply to a later call, the workers never see the new state without it
+            self.__push_snapshot__()
+        elif topic == Topic.SCOREBOARD and self._snapshot is None:
+            self._snapshot = asyncio.get_running_loop().call_later(SNAPSHOT_INTERVAL, self.__push_snapshot__)
+    
+    
+    def __push_snapshot__(self):
+        if self._snapshot is not None:
+            self._snapshot.cancel()
+            self._snapshot = None
+        self.__send__(("snapshot", {**self.base.contest.snapshot(), "seq": self.base.ws_manager.seq}))
+    
+    
+    async def __handle__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.workers.add(writer)
+        logger.info(f"Worker connected, {len(self.workers)} in total")
+        try:
+            while True:
+                _, call_id, method, args = await __read_frame__(reader)
+                asyncio.create_task(self.__dispatch__(writer, call_id, method, args))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Backplane connection failed: {e}")
+        finally:
+            self.workers.discard(writer)
+            writer.close()
+            logger.info(f"Worker disconnected, {len(self.workers)} left")
+    
+    
+    async def __dispatch__(self, writer: asyncio.StreamWriter, call_id: int, method: str, args: tuple):
+        self.calls += 1
+        try:
+            if method not in CALLS:
+                raise ValueError(f"Unknown method {method}")
+            result = getattr(self.base, method)(*args)
+            if asyncio.iscoroutine(result):
+                result = await result
+            reply = ("result", call_id, result)
+        except QueueFullError as e:
+            reply = ("error", call_id, "queue_full", (e.retry_after, e.per_contestant))
+        except RateLimitError as e:
+            reply = ("error", call_id, "rate_limited", (e.retry_after, e.per_contestant))
+        except Exception as e:
+            reply = ("error", call_id, type(e).__name__, (str(e),))
+        if method == "submit":
+            # Monotonic time is the same in every process, the workers answer the status themselves
+            self.__send__(("bucket", args[0], self.base.limiter.get_bucket(args[0])))
+        if not writer.is_closing():
+            writer.write(__frame__(reply))
+
+
+# Stands in for BaseLoader in a worker process: serves HTTP and websockets, keeps a replica of the
+# little contest state the router reads on every request and forwards everything else to the core
+class WorkerLoader:
+    def __init__(self, path: str):
+        self.path: str = path
+        self.server: FastAPI = fastapi.FastAPI(on_startup=[self.startup])
+        self.server.state.loader = self
+        self.tokens = auth.TokenCache(int(os.getenv("TOKEN_CACHE_SIZE", 10000)))
+        # The buckets of the contestants are copied from the contest process, they reject a submission before its
+        # upload is read. The server bucket is only checked by the contest process
+        self.limiter = SubmissionLimiter()
+        self.limiter.server = None
+        self.ws_manager = WebSocketManager()
+        self.problem_manager = ProblemManager()
+        self.problem_watcher = ProblemWatcher(self.problem_manager)
+        self.progress: ContestProgress = ContestProgress.NOT_STARTED
+        self.contestants: set[UUID] = set()
+        self.problems: list[str] = []
+        self._problem_set: set[str] = set()
+        self.public: dict = {}
+        # Serialized once per snapshot: (snapshot, contestants, contest, hash)
+        self._public_json: Optional[tuple[dict, str, Optional[str], str]] = None
+        # Part of the restore payload of each contestant, fetched once after every change of it:
+        # uid -> (JSON without the closing brace, in progress, hash)
+        self.private: dict[UUID, tuple[str, bool, str]] = {}
+        # Bumped when the part of a contestant changes, a fetch crossing a change is not kept
+        self._revisions: dict[UUID, int] = {}
+        self.ws_manager.snapshot = lambda: {**self.public, "elapsed": self.elapsed}
+        # Monotonic time the contest started at, to follow the timer of the contest process
+        self.started: float = 0
+        self.timeout: float = float(os.getenv("BACKPLANE_TIMEOUT", 10))
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._calls: dict[int, asyncio.Future] = {}
+        self._ids = itertools.count()
+        self._ready = asyncio.Event()
+        
+        self.server.add_api_route("/", root)
+        self.server.add_api_route("/index.html", root)
+        self.server.add_api_route("/favicon.ico", favicon)
+        self.server.add_websocket_route("/ws", self.ws_manager.endpoint)
+    
+    
+    async def startup(self):
+        self.problem_watcher.start()
+        asyncio.create_task(self.__connect__())
+        await asyncio.wait_for(self._ready.wait(), self.timeout)
+    
+    
+    async def __connect__(self):
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.path)
+                # Read in the background, the state call needs the reader running
+                reading = asyncio.create_task(self.__reader__(reader))
+                self.__apply_state__(await self.__request__("state"))
+                self._ready.set()
+                await reading
+            except Exception as e:
+                logger.error(f"Backplane connection failed: {e or type(e).__name__}")
+            self._writer = None
+            for future in self._calls.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Backplane connection lost"))
+            self._calls.clear()
+            await asyncio.sleep(1)
+    
+    
+    async def __reader__(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                item = await __read_frame__(reader)
+                if item[0] == "event":
+                    self.__apply_event__(item[2], item[1])
+                    self.ws_manager.relay(item[2], item[1])
+                elif item[0] == "snapshot":
+                    self.public = item[1]
+                elif item[0] == "bucket":
+                    self.limiter.set_bucket(item[1], item[2])
+                else:
+                    future = self._calls.pop(item[1], None)
+                    if future is None or future.done():
+                        continue
+                    if item[0] == "result":
+                        future.set_result(item[2])
+                    elif item[2] == "queue_full":
+                        future.set_exception(QueueFullError(*item[3]))
+                    elif item[2] == "rate_limited":
+                        future.set_exception(RateLimitError(*item[3]))
+                    elif item[2] == "ValueError":
+                        future.set_exception(ValueError(*item[3]))
+                    else:
+                        future.set_exception(RuntimeError(*item[3]))
+        except asyncio.IncompleteReadError:
+            logger.error("Backplane closed by the contest process")
+    
+    
+    def __apply_state__(self, state: dict):
+        self.progress = state["progress"]
+        self.started = time.monotonic() - state["elapsed"]
+        self.contestants = set(state["contestants"])
+        self.problems = state["problems"]
+        self._problem_set = set(self.problems)
+        self.public = state["snapshot"]
+        self.tokens.clear()
+        self.__invalidate__()
+        self.limiter.clear()
+        for uid, bucket in state["buckets"].items():
+            self.limiter.set_bucket(uid, bucket)
+        # Events missed while disconnected are not in the history, resuming clients get the snapshot
+        self.ws_manager.clear_history()
+        self.ws_manager.seq = self.public["seq"]
+    
+    
+    def __apply_event__(self, message: dict, topic: str):
+        event = message.get("event", None)
+        if event == "NEW_CONTESTANT":
+            self.contestants.add(UUID(message["uid"]))
+        elif event == "CONTEST_STARTED":
+            self.progress = ContestProgress.IN_PROGRESS
+            self.started = time.monotonic()
+            self.problems = message["problems"]
+            self._problem_set = set(self.problems)
+            self.__invalidate__()
+        elif event == "CONTEST_STOPPED":
+            self.progress = ContestProgress.FINISHED
+            self.__invalidate__()
+        elif event == "CONTEST_RESET":
+            self.progress = ContestProgress.NOT_STARTED
+            self.contestants.clear()
+            self.problems = []
+            self._problem_set = set()
+            self.ws_manager.clear_history()
+            self.tokens.clear()
+            self.limiter.clear()
+            self.__invalidate__()
+        elif event == "SUBMISSION_VERDICT":
+            self.__invalidate__(UUID(topic.split(":", 1)[1]))
+        elif event == "CONTESTANT_FINISHED":
+            self.__invalidate__(UUID(message["uid"]))
+        elif event == "SCOREBOARD_DELTA":
+            for uid, entry in message["contestants"].items():
+                if entry.get("finished", False):
+                    self.__invalidate__(UUID(uid))
+    
+    
+    def __invalidate__(self, uid: Optional[UUID] = None):
+        if uid is None:
+            self.private.clear()
+            for key in self._revisions:
+                self._revisions[key] += 1
+            return
+        self.private.pop(uid, None)
+        self._revisions[uid] = self._revisions.get(uid, 0) + 1
+    
+    
+    async def __request__(self, method: str, *args):
+        if self._writer is None:
+            raise ConnectionError("Not connected to the contest process")
+        call_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._calls[call_id] = future
+        self._writer.write(__frame__(("call", call_id, method, args)))
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self._calls.pop(call_id, None)
+    
+    
+    # Same contest access as BaseLoader
+    @property
+    def elapsed(self) -> int:
+        if self.progress is not ContestProgress.IN_PROGRESS:
+            return 0
+        return int(time.monotonic() - self.started)
+    
+    
+    def scoreboard_page(self, offset: int, limit: int) -> dict:
+        # Paged from the replicated snapshot, which is in ranking order
+        contestants = self.public.get("contestants", [])
+        return {"total": len(contestants), "offset": offset, "contestants": contestants[offset:offset + limit]}
+    
+    
+    def has_contestant(self, uid: UUID) -> bool:
+        return uid in self.contestants
+    
+    
+    def problem_names(self) -> list[str]:
+        return self.problems
+    
+    
+    def get_problem(self, name: str) -> Optional[Problem]:
+        if name not in self._problem_set:
+            return None
+        return self.problem_manager.problems.get(name, None)
+    
+    
+    async def add_contestant(self, name: str, color: Optional[str]) -> Optional[UUID]:
+        return await self.__request__("add_contestant", name, color)
+    
+    
+    async def submit(self, uid: UUID, problem: str, language: str, code: bytes) -> Optional[dict]:
+        return await self.__request__("submit", uid, problem, language, code)
+    
+    
+    def __public_json__(self) -> tuple[str, Optional[str], str]:
+        public = self.public
+        if self._public_json is None or self._public_json[0] is not public:
+            contestants = json.dumps(public.get("contestants", []))
+            contest = json.dumps(public["contest"]) if "contest" in public else None
+            digest = zlib.crc32(f"{public.get('seq', 0)}{contestants}{contest}".encode())
+            self._public_json = (public, contestants, contest, f"{digest:08x}")
+        return self._public_json[1], self._public_json[2], self._public_json[3]
+    
+    
+    async def restore(self, uid: UUID, etag: Optional[str] = None) -> tuple[str, Optional[str], tuple[int, int]]:
+        # Built from the replicated snapshot, only the part of the contestant comes from the contest process,
+        # once after each change of it. The ETag only depends on the content, every worker gives the same
+        private = self.private.get(uid, None)
+        if private is None:
+            revision = self._revisions.get(uid, 0)
+            data = await self.__request__("contestant_state", uid)
+            text = json.dumps(data)[:-1]
+            private = (text, data["contest_progress"] == ContestProgress.IN_PROGRESS.name, f"{zlib.crc32(text.encode()):08x}")
+            if self._revisions.get(uid, 0) == revision:
+                self.private[uid] = private
+        text, in_progress, digest = private
+        contestants, contest, public_digest = self.__public_json__()
+        tag = f'"{public_digest}-{digest}"'
+        if etag == tag:
+            return tag, None, self.limiter.status(uid)
+        body = text + f',"seq":{self.public.get("seq", 0)},"limits":{json.dumps(self.limiter.limits())},"contestants":{contestants}'
+        if in_progress and contest is not None:
+            body += f',"contest":{contest}'
+        return tag, body + "}", self.limiter.status(uid)
+    
+    
+    async def finish(self, uid: UUID) -> bool:
+        return await self.__request__("finish", uid)
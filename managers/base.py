@@ -1,5 +1,9 @@
 import asyncio
+import json
 import logging
+import os
+import time
+from typing import Optional
 from uuid import UUID
 
 import fastapi
@@ -9,10 +13,16 @@ from signal import SIGINT
 
 from api.ws import WebSocketManager
 from managers.contests import Contest
+from managers.data import Submission
+from managers.journal import ContestJournal
 from managers.problems import ProblemManager, Problem
+from managers.ratelimit import SubmissionLimiter
 from managers.sandbox import SandboxManager
-from utils import console
-from utils.enums import ContestProgress
+from managers.scoreboard import ScoreboardCoalescer
+from managers.watcher import ProblemWatcher
+from managers.sync import TestdataSync
+from utils import auth, console
+from utils.enums import ContestProgress, SubmissionStatus, Topic
 
 logger = logging.getLogger(__name__)
 
@@ -27,14 +37,28 @@ async def favicon():
 
 class BaseLoader:
     def __init__(self):
-        self.server: FastAPI = fastapi.FastAPI(on_startup=[
-            lambda: asyncio.create_task(console.start_shell(self.handle_shell_command)),
-            lambda: self.sandbox_manager.load()
-        ])
+        self.server: FastAPI = fastapi.FastAPI(on_startup=[self.startup], on_shutdown=[self.shutdown])
+        # Reached by the request dependencies of the HTTP router
+        self.server.state.loader = self
+        self.tokens = auth.TokenCache(int(os.getenv("TOKEN_CACHE_SIZE", 10000)))
+        self.limiter = SubmissionLimiter()
         self.ws_manager = WebSocketManager()
+        self.scoreboard = ScoreboardCoalescer(self.__publish__, lambda uid: self.contest.rank(uid))
+        # Called with every event after the local clients got it, used by the backplane in multi-worker mode
+        self.on_publish: Optional[callable] = None
         self.problem_manager = ProblemManager()
-        self.sandbox_manager = SandboxManager()
-        self.contest: Contest = Contest(self.get_available_problems, self.sandbox_manager, self.broadcast)
+        self.sandbox_manager = SandboxManager(self.problem_manager.get_version)
+        self.testdata_sync = TestdataSync(self.problem_manager)
+        self.sandbox_manager.on_node_ready = self.testdata_sync.schedule
+        self.problem_watcher = ProblemWatcher(self.problem_manager)
+        self.problem_watcher.on_change = self.__problem_changed__
+        # Contest write-ahead log, JOURNAL_DIR empty disables it
+        journal_dir = os.getenv("JOURNAL_DIR", "journal")
+        self.journal: Optional[ContestJournal] = ContestJournal(journal_dir) if journal_dir else None
+        self.contest: Contest = Contest(self.get_available_problems, self.sandbox_manager, self.broadcast, self.journal)
+        if self.journal:
+            self.__recover__()
+        self.ws_manager.snapshot = lambda: {**self.contest.snapshot(), "elapsed": self.contest.elapsed}
         
         self.server.add_api_route("/", root)
         self.server.add_api_route("/index.html", root)
@@ -42,6 +66,46 @@ class BaseLoader:
         self.server.add_websocket_route("/ws", self.ws_manager.endpoint)
         
         
+    async def startup(self):
+        asyncio.create_task(console.start_shell(self.handle_shell_command))
+        self.sandbox_manager.load()
+        self.problem_watcher.start()
+        self.contest.resume()
+    
+    
+    def shutdown(self):
+        # Waits for the journal to reach the disk
+        if self.journal:
+            self.journal.close()
+    
+    
+    def __recover__(self):
+        started = time.monotonic()
+        data, records = self.journal.recover()
+        problems = self.problem_manager.problems
+        if data:
+            self.contest.load(data, problems)
+        for record in records:
+            self.contest.apply(record, problems)
+        self.journal.start()
+        if data or records:
+            # Compacted right away, the next start does not replay the same records again
+            if records:
+                self.journal.snapshot(self.contest.dump())
+            logger.info(
+                f"Recovered the contest ({self.contest.progress.name}, {len(self.contest.contestants)} contestants, "
+                f"{len(records)} records replayed) in {time.monotonic() - started:.2f}s"
+            )
+    
+    
+    def __problem_changed__(self, name: str, state: str):
+        # Judges keep up with the new testdata, the verdict cache already misses on the new version
+        if state == "removed":
+            return
+        for node in self.sandbox_manager.nodes.values():
+            self.testdata_sync.schedule(node, [name])
+        
+        
     def get_available_problems(self) -> list[Problem]:
         local: set[str] = set(self.problem_manager.problems.keys())
         in_nodes: set[str] = set(self.sandbox_manager.get_supported_problems())
@@ -85,18 +149,62 @@ class BaseLoader:
                 if not node.ready:
                     text += " - DISCONNECTED\n"
                     continue
-                text += f" - Version: {node.version} - In queue: {node.in_queue}\n"
+                if node.breaker_open:
+                    text += " - CIRCUIT OPEN"
+                p95 = node.latency_p95(1)
+                text += f" - Version: {node.version} - Slots: {node.slots} - In flight: {node.in_flight} - In queue: {node.in_queue}"
+                if node.batches:
+                    text += f" - Batches: {node.batches} (avg {node.batched / node.batches:.1f})"
+                text += f" - p95: {p95:.2f}s\n" if p95 is not None else "\n"
+            text += f"Hedged dispatches: {self.sandbox_manager.hedges} (won by the backup: {self.sandbox_manager.hedge_wins})\n"
+            text += f"Failovers: {self.sandbox_manager.failovers}\n"
             logger.warning("Command: \"sandboxes\"\n%s", text)
             
+        elif command[0] == "queue":
+            queue = self.sandbox_manager.queue
+            text = f"Depth: {queue.size}/{queue.max_size} - Enqueued: {queue.total_enqueued}"
+            text += f" - Dispatched: {queue.total_dispatched} - Rejected: {queue.total_rejected}\n"
+            text += f"Wait: avg {queue.average_wait():.2f}s - recent {queue.recent_wait:.2f}s - max {queue.max_wait:.2f}s\n"
+            pending = queue.pending()
+            for contestant_id in set(pending).union(queue.dispatched):
+                contestant = self.contest.contestants.get(contestant_id, None)
+                share = queue.dispatched.get(contestant_id, 0) / queue.total_dispatched if queue.total_dispatched else 0
+                text += f"{contestant.name if contestant else contestant_id} - Pending: {pending.get(contestant_id, 0)}"
+                text += f" - Dispatched: {queue.dispatched.get(contestant_id, 0)} ({share:.0%})\n"
+            logger.warning("Command: \"queue\"\n%s", text)
+            
+        elif command[0] == "cache":
+            cache = self.sandbox_manager.cache
+            if len(command) > 1 and command[1] == "clear":
+                cache.clear()
+                logger.warning("Command: \"cache clear\" - Success")
+                return
+            lookups = cache.hits + cache.misses
+            logger.warning(
+                "Command: \"cache\"\nEntries: %d - Size: %.1f/%.1f KiB - Hits: %d - Misses: %d (%.0f%% hit rate) - Shared in flight: %d",
+                len(cache), cache.size / 1024, cache.max_bytes / 1024, cache.hits, cache.misses,
+                100 * cache.hits / lookups if lookups else 0, cache.shared
+            )
+            
         elif command[0] == "languages":
             logger.warning("Command: \"languages\"\n%s", self.sandbox_manager.get_supported_languages())
             
         elif command[0] == "problems":
-            logger.warning("Command: \"problems\"\n%s", [problem.name for problem in self.get_available_problems()])
+            logger.warning(
+                "Command: \"problems\"\n%s\nLoaded: %d",
+                [problem.name for problem in self.get_available_problems()], len(self.problem_manager.problems)
+            )
+            
+        elif command[0] == "reload":
+            await self.problem_watcher.rescan()
+            logger.warning(
+                "Command: \"reload\" - %d problems loaded, %d reloads so far (%s)",
+                len(self.problem_manager.problems), self.problem_watcher.reloads, self.problem_watcher.backend or "not watching"
+            )
             
         elif command[0] == "add":
             try:
-                result = self.sandbox_manager.add(command[1])
+                result = self.sandbox_manager.add(command[1], int(command[2]) if len(command) > 2 else None)
                 logger.warning("Command: \"add\" - %s", "Success" if result else "Not found")
             except Exception as e:
                 logger.warning("Command: \"add\" - Failed: %s", e)
@@ -108,18 +216,53 @@ class BaseLoader:
             except Exception as e:
                 logger.warning("Command: \"remove\" - Failed: %s", e)
         
+        elif command[0] == "sync":
+            problems = [command[1]] if len(command) > 1 else None
+            if problems and problems[0] not in self.problem_manager.problems:
+                logger.warning("Command: \"sync\" - Problem not found")
+                return
+            for node in self.sandbox_manager.nodes.values():
+                self.testdata_sync.schedule(node, problems)
+            logger.warning(
+                "Command: \"sync\" - Started. Sent so far: %d files, %.1f MiB compressed",
+                self.testdata_sync.files_sent, self.testdata_sync.bytes_sent / 1024 / 1024
+            )
+        
         elif command[0] == "contestants":
             text = ""
-            for contestant in self.contest.contestants.values():
+            for rank, contestant in self.contest.ranking.page():
                 text += f"{str(contestant.id)} - {contestant.name} - {contestant.color}\n"
                 if self.contest.progress is not ContestProgress.NOT_STARTED:
-                    text += f" └ Score: {contestant.score}"
+                    text += f" └ #{rank} - Score: {contestant.score}"
                     for problem in self.contest.problems:
                         text += f" - {problem.name}: {contestant.state.get(problem.name, 'PENDING')}"
                     if contestant.finished > 0:
                         text += f" - Finished at {contestant.finished // 60}m {contestant.finished % 60}s"
                     text += "\n"
             logger.warning("Command: \"contestants\"\n%s", text)
+        
+        elif command[0] == "ws":
+            ws = self.ws_manager
+            text = f"Clients: {len(ws.clients)} (limit {ws.max_clients}, per address {ws.max_per_ip or 'unlimited'})\n"
+            text += f"Connects: {ws.connects}, disconnects: {ws.disconnects}, rejected: {ws.rejected}, reaped: {ws.reaped}\n"
+            text += f"Disconnected for overflow: {ws.overflowed}, dropped events: {sum(c.dropped for c in ws.clients)}\n"
+            text += f"Replays: {ws.replays}, snapshots: {ws.snapshots} ({ws.resyncs} after an overflow), last event: {ws.seq}\n"
+            for topic, subscribers in sorted(ws.topics.items(), key=lambda item: -len(item[1]))[:10]:
+                text += f" └ {topic}: {len(subscribers)}\n"
+            logger.warning("Command: \"ws\"\n%s", text)
+        
+        elif command[0] == "journal":
+            journal = self.journal
+            if journal is None:
+                logger.warning("Command: \"journal\" - Disabled")
+                return
+            logger.warning(
+                "Command: \"journal\" - Records: %d - Written: %d in %d batches - Failed: %d - Snapshots: %d - Since last: %d",
+                journal.seq, journal.written, journal.batches, journal.failed, journal.snapshots, journal.pending
+            )
+        
+        elif command[0] == "token":
+            logger.warning("Command: \"token\" - Admin token for the websocket \"admin\" topic:\n%s", auth.generate_admin_token())
             
         elif command[0] == "help":
             logger.warning("""Command: \"help\"
@@ -128,13 +271,20 @@ class BaseLoader:
             --- General commands ---
             languages - List all supported languages
             problems - List all available problems
+            reload - Scan the problems directory for changes now
             help - Display this help message
+            ws - Show the websocket connection statistics
+            journal - Show the contest journal statistics
+            token - Print an admin token for the websocket event stream
             exit - Exit the program
             
             --- Sandbox manage commands ---
             list - List all sandboxes
-            add - Add a new sandbox
+            queue - Show the judging queue statistics
+            cache [clear] - Show (or clear) the verdict cache statistics
+            add <url> [slots] - Add a new sandbox
             remove <node_id> - Remove a sandbox
+            sync [problem] - Push changed testdata to the sandboxes
             
             --- Contest manage commands ---
             contestants - List all contestants
@@ -146,15 +296,150 @@ class BaseLoader:
             logger.warning("Unknown command")
             
         
-    def broadcast(self, message: dict):
-        asyncio.create_task(self.ws_manager.broadcast(message))
+    def broadcast(self, message: dict, topic: str = Topic.SCOREBOARD):
+        if topic == Topic.SCOREBOARD:
+            if self.scoreboard.add(message):
+                return
+            # Pending updates go out first, so the clients see the events in order
+            self.scoreboard.flush()
+        self.__publish__(message, topic)
+    
+    
+    def __publish__(self, message: dict, topic: str):
+        self.ws_manager.broadcast(message, topic)
+        if self.on_publish:
+            self.on_publish(message, topic)
         
         
     def reset_contest(self):
         if self.contest:
             self.contest.stop()
-        self.contest = Contest(self.get_available_problems, self.sandbox_manager, self.broadcast)
+        self.contest = Contest(self.get_available_problems, self.sandbox_manager, self.broadcast, self.journal)
+        if self.journal:
+            self.journal.reset()
+        self.ws_manager.clear_history()
+        self.tokens.clear()
+        self.limiter.clear()
         self.broadcast({"event": "CONTEST_RESET"})
         logger.info("Contest has been reset")
         
-        
\ No newline at end of file
+        
+    # Contest access for the HTTP router. WorkerLoader offers the same methods over the backplane
+    @property
+    def progress(self) -> ContestProgress:
+        return self.contest.progress
+    
+    
+    def scoreboard_page(self, offset: int, limit: int) -> dict:
+        return self.contest.scoreboard(offset, limit)
+    
+    
+    def has_contestant(self, uid: UUID) -> bool:
+        return uid in self.contest.contestants
+    
+    
+    def problem_names(self) -> list[str]:
+        return [problem.name for problem in self.contest.problems]
+    
+    
+    def get_problem(self, name: str) -> Optional[Problem]:
+        # The store has the current copy, a problem removed from the disk during the contest is gone
+        if name not in self.contest.problem_index:
+            return None
+        return self.problem_manager.problems.get(name, None)
+    
+    
+    async def add_contestant(self, name: str, color: Optional[str]) -> Optional[UUID]:
+        return self.contest.add_contestant(name, color)
+    
+    
+    async def submit(self, uid: UUID, problem: str, language: str, code: bytes) -> Optional[dict]:
+        # Returns None when the contestant already solved the problem, raises RateLimitError when submitting
+        # too often and QueueFullError when the judging queue is busy. Only a queued submission takes a token
+        contestant = self.contest.contestants[uid]
+        if contestant.state.get(problem, None) is SubmissionStatus.ACCEPTED:
+            return None
+        self.limiter.check(uid)
+        submission = Submission(
+            contestant_id=contestant.id,
+            problem=problem,
+            language=language,
+            time=self.contest.elapsed,
+            code=code
+        )
+        self.sandbox_manager.enqueue(submission, self.contest.submission_callback, self.contest.submission_progress)
+        self.limiter.take(uid)
+        return {
+            "id": str(submission.id),
+            "problem": submission.problem,
+            "language": submission.language,
+            "result": submission.status.name,
+            "time": submission.time
+        }
+    
+    
+    async def restore(self, uid: UUID, etag: Optional[str] = None) -> tuple[str, Optional[str], tuple[int, int]]:
+        # Returns the ETag and the JSON body, or no body when the copy of the client is still up to date.
+        # Only the part of the contestant is built here, the public part is serialized once per version.
+        # The submissions left and the cooldown change all the time, they are returned aside
+        tag = f'"{self.contest.epoch}-{self.contest.version}-{uid}"'
+        if etag == tag:
+            return tag, None, self.limiter.status(uid)
+        data = self.contestant_state(uid)
+        # Resume the event stream from here with /ws?since=<seq>
+        data["seq"] = self.ws_manager.seq
+        data["limits"] = self.limiter.limits()
+        contestants, contest = self.contest.snapshot_json()
+        body = json.dumps(data)[:-1] + f',"contestants":{contestants}'
+        if data["contest_progress"] == ContestProgress.IN_PROGRESS.name:
+            body += f',"contest":{contest}'
+        logger.info(f"Restored session for {data['name']}")
+        return tag, body + "}", self.limiter.status(uid)
+    
+    
+    def contestant_state(self, uid: UUID) -> dict:
+        # The part of the restore payload that belongs to the contestant, the workers only fetch this
+        contestant = self.contest.contestants[uid]
+        progress = self.contest.progress
+        if contestant.finished > 0 and self.contest.progress is ContestProgress.IN_PROGRESS:
+            progress = ContestProgress.FINISHED
+        data = {
+            "uid": str(uid),
+            "name": contestant.name,
+            "contest_progress": progress.name
+        }
+        if contestant.color is not None:
+            data["color"] = contestant.color
+        if progress is ContestProgress.IN_PROGRESS:
+            data["submissions"] = []
+            for submission in contestant.submissions:
+                data["submissions"].append({
+                    "id": str(submission.id),
+                    "problem": submission.problem,
+                    "language": submission.language,
+                    "result": submission.status.name,
+                    "time": submission.time
+                })
+        return data
+    
+    
+    @property
+    def elapsed(self) -> int:
+        return self.contest.elapsed
+    
+    
+    async def finish(self, uid: UUID) -> bool:
+        return self.contest.mark_finished(uid)
+    
+    
+    def state(self) -> dict:
+        # Everything a worker needs to serve the contest, followed by the events from then on
+        return {
+            "progress": self.contest.progress,
+            "contestants": list(self.contest.contestants),
+            "problems": self.problem_names(),
+            "elapsed": self.contest.elapsed,
+            "snapshot": {**self.contest.snapshot(), "seq": self.ws_manager.seq},
+            "buckets": {uid: self.limiter.get_bucket(uid) for uid in self.limiter.buckets}
+        }
+    
\ No newline at end of file
@@ -0,0 +1,73 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Optional
+
+from managers.data import Submission
+from utils.enums import SubmissionStatus
+
+# Rough per-entry bookkeeping cost of the OrderedDict node, tuples and enum reference
+ENTRY_OVERHEAD = 256
+
+
+# LRU cache of final verdicts and their messages (e.g. the compiler output) keyed by
+# (problem, language, sha256(code), testdata version).
+# Only deterministic verdicts are stored, internal errors are always judged again
+class VerdictCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes: int = max_bytes
+        self.size: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.shared: int = 0
+        self._entries: OrderedDict[tuple, tuple[SubmissionStatus, Optional[str]]] = OrderedDict()
+        # Identical submissions being judged right now, the others wait for their verdict
+        self.in_flight: dict[tuple, asyncio.Future] = {}
+    
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+    
+    
+    @staticmethod
+    def key(submission: Submission, version: str) -> tuple:
+        return submission.problem, submission.language, hashlib.sha256(submission.code).hexdigest(), version
+    
+    
+    @staticmethod
+    def __entry_size__(key: tuple, message: Optional[str]) -> int:
+        return ENTRY_OVERHEAD + sum(len(part) for part in key) + len(message or "")
+    
+    
+    def get(self, key: tuple) -> Optional[tuple[SubmissionStatus, Optional[str]]]:
+        verdict = self._entries.get(key, None)
+        if verdict is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return verdict
+    
+    
+    def put(self, key: tuple, status: SubmissionStatus, message: Optional[str] = None):
+        if status in (SubmissionStatus.PENDING, SubmissionStatus.INTERNAL_ERROR):
+            return
+        old = self._entries.get(key, None)
+        if old is not None:
+            self.size -= self.__entry_size__(key, old[1])
+        self.size += self.__entry_size__(key, message)
+        self._entries[key] = (status, message)
+        self._entries.move_to_end(key)
+        while self.size > self.max_bytes and self._entries:
+            old_key, (_, old_message) = self._entries.popitem(last=False)
+            self.size -= self.__entry_size__(old_key, old_message)
+    
+    
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+    
+    
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -1,29 +1,46 @@
 import asyncio
+import json
 import logging
 import random
+import time
 from typing import Optional
-from uuid import UUID
+from uuid import UUID, uuid4
 
 from managers.data import Contestant, Submission
+from managers.journal import ContestJournal
 from managers.problems import Problem
+from managers.ranking import Ranking
 from managers.sandbox import SandboxManager
-from utils.enums import ContestProgress, SubmissionStatus
+from utils.enums import ContestProgress, SubmissionStatus, Topic
 
 logger = logging.getLogger(__name__)
 
 
 class Contest:
-    def __init__(self, get_available_problems: callable, sandbox_manager: SandboxManager, broadcast: callable):
+    def __init__(self, get_available_problems: callable, sandbox_manager: SandboxManager, broadcast: callable,
+                 journal: Optional[ContestJournal] = None):
         self.get_available_problems = get_available_problems
         self.sandbox_manager = sandbox_manager
         self.broadcast = broadcast
+        # Every change of the state is recorded here, so the contest survives a restart
+        self.journal: Optional[ContestJournal] = journal
         self.progress: ContestProgress = ContestProgress.NOT_STARTED
         self.duration: int = 0
         self.elapsed: int = 0
+        # Wall clock time the contest started at, the timer resumes from it after a restart
+        self.started_at: float = 0
         self.problems: list[Problem] = []
+        # The same problems by name, for the lookups of every request
+        self.problem_index: dict[str, Problem] = {}
         self.contestants: dict[UUID, Contestant] = {}
+        self.ranking: Ranking = Ranking()
         self.supported_languages: list[str] = []
         self._timer: Optional[asyncio.Task] = None
+        # Bumped on every change of the state, the public snapshot is only rebuilt when it changed
+        self.epoch: str = uuid4().hex[:8]
+        self.version: int = 0
+        self._snapshot: Optional[tuple[int, dict]] = None
+        self._snapshot_json: Optional[tuple[int, str, str]] = None
         
         
     async def __timer__(self):
@@ -33,6 +50,71 @@ class Contest:
             await asyncio.sleep(1)
             self.elapsed += 1
         self.stop()
+    
+    
+    def resume(self):
+        # Restarts the timer of a recovered contest, the time the server was down counts as well
+        if self.progress is not ContestProgress.IN_PROGRESS or self._timer is not None:
+            return
+        self.elapsed = min(self.duration, int(time.time() - self.started_at))
+        self._timer = asyncio.create_task(self.__timer__())
+    
+    
+    def __record__(self, record: dict):
+        if self.journal is not None and self.journal.append(record):
+            self.journal.snapshot(self.dump())
+    
+    
+    def snapshot(self) -> dict:
+        # Public state of the contest, the same for every client. Shared, must not be modified
+        if self._snapshot is not None and self._snapshot[0] == self.version:
+            return self._snapshot[1]
+        data = {
+            "contest_progress": self.progress.name,
+            # In ranking order
+            "contestants": [self.__public__(rank, c) for rank, c in self.ranking.page()]
+        }
+        if self.progress is ContestProgress.IN_PROGRESS:
+            data["contest"] = {
+                "duration": self.duration,
+                "problems": [problem.name for problem in self.problems],
+                "supported_languages": self.supported_languages
+            }
+        self._snapshot = (self.version, data)
+        return data
+    
+    
+    @staticmethod
+    def __public__(rank: int, contestant: Contestant) -> dict:
+        return {
+            "uid": str(contestant.id),
+            "name": contestant.name,
+            "color": contestant.color,
+            "score": contestant.score,
+            "rank": rank,
+            "progress": {problem: status.name for problem, status in contestant.state.items()},
+            "finished": contestant.finished
+        }
+    
+    
+    def scoreboard(self, offset: int, limit: int) -> dict:
+        return {
+            "total": len(self.ranking),
+            "offset": offset,
+            "contestants": [self.__public__(rank, c) for rank, c in self.ranking.page(offset, limit)]
+        }
+    
+    
+    def rank(self, uid: str) -> int:
+        return self.ranking.rank(uid)
+    
+    
+    def snapshot_json(self) -> tuple[str, str]:
+        # The contestants and contest parts of the snapshot, serialized once per version
+        if self._snapshot_json is None or self._snapshot_json[0] != self.version:
+            data = self.snapshot()
+            self._snapshot_json = (self.version, json.dumps(data["contestants"]), json.dumps(data.get("contest", None)))
+        return self._snapshot_json[1], self._snapshot_json[2]
         
     
     def add_contestant(self, name: str, color: Optional[str]) -> Optional[UUID]:
@@ -40,6 +122,9 @@ class Contest:
             return None
         c = Contestant(name, color)
         self.contestants[c.id] = c
+        self.ranking.update(c)
+        self.version += 1
+        self.__record__({"e": "add", "id": str(c.id), "name": name, "color": color})
         self.broadcast({
             "event": "NEW_CONTESTANT",
             "uid": str(c.id),
@@ -68,9 +153,12 @@ class Contest:
         if not self.problems:
             logger.warning("Starting contest with no problems")
             return False
+        self.problem_index = {p.name: p for p in self.problems}
         
         self.duration = duration
+        self.started_at = time.time()
         self.progress = ContestProgress.IN_PROGRESS
+        self.version += 1
         contestants_data = []
         for contestant in self.contestants.values():
             contestant.state = {p.name: SubmissionStatus.PENDING for p in self.problems}
@@ -82,6 +170,13 @@ class Contest:
                 "progress": {p.name: SubmissionStatus.PENDING.name for p in self.problems}
             })
         self._timer = asyncio.create_task(self.__timer__())
+        self.__record__({
+            "e": "start",
+            "duration": duration,
+            "started_at": self.started_at,
+            "problems": [p.name for p in self.problems],
+            "languages": self.supported_languages
+        })
         self.broadcast({
             "event": "CONTEST_STARTED",
             "duration": duration,
@@ -102,6 +197,8 @@ class Contest:
                 self.mark_finished(contestant.id)
 
         self.progress = ContestProgress.FINISHED
+        self.version += 1
+        self.__record__({"e": "stop", "elapsed": self.elapsed})
         
         if self._timer:
             self._timer.cancel()
@@ -122,12 +219,17 @@ class Contest:
         if contestant_id not in self.contestants:
             return False
         contestant = self.contestants[contestant_id]
+        finished = contestant.finished
         contestant.mark_finished(self.elapsed)
-        contestant.refresh_score()
+        self.ranking.update(contestant)
+        self.version += 1
+        if finished == 0:
+            self.__record__({"e": "finish", "contestant": str(contestant_id), "time": contestant.finished})
         self.broadcast({
             "event": "CONTESTANT_FINISHED",
             "uid": str(contestant_id),
-            "score": self.contestants[contestant_id].refresh_score()
+            "score": contestant.score,
+            "rank": self.ranking.rank(str(contestant_id))
         })
         return True
     
@@ -140,18 +242,151 @@ class Contest:
             logger.warning("Ignored submission %s: Unknown contestant", submission.id)
             return
         contestant = self.contestants[submission.contestant_id]
-        if not contestant.add_submission(submission):
+        if contestant.add_submission(submission):
+            self.__record__({
+                "e": "verdict",
+                "id": str(submission.id),
+                "contestant": str(contestant.id),
+                "problem": submission.problem,
+                "language": submission.language,
+                "time": submission.time,
+                "status": submission.status.name
+            })
+        else:
             logger.warning("Submission %s has been rejected", submission.id)
+        self.ranking.update(contestant)
+        self.version += 1
+        # Public result for the scoreboard, the details only go to the contestant
         self.broadcast({
             "event": "SUBMISSION_RESULT",
-            "id": str(submission.id),
             "contestant": str(contestant.id),
             "problem": submission.problem,
-            "language": submission.language,
             "status": submission.status.name,
             "time": submission.time,
-            "score": contestant.refresh_score()
+            "score": contestant.score,
+            "rank": self.ranking.rank(str(contestant.id))
         })
+        self.broadcast({
+            "event": "SUBMISSION_VERDICT",
+            "id": str(submission.id),
+            "problem": submission.problem,
+            "language": submission.language,
+            "status": submission.status.name,
+            "time": submission.time,
+            "message": submission.message
+        }, f"{Topic.CONTESTANT}:{contestant.id}")
         if contestant.finished > 0:
             self.mark_finished(contestant.id)
-        
\ No newline at end of file
+            
+    
+    async def submission_progress(self, submission: Submission, testcase: int, total: int, status: SubmissionStatus):
+        if self.progress is not ContestProgress.IN_PROGRESS:
+            return
+        self.broadcast({
+            "event": "SUBMISSION_PROGRESS",
+            "id": str(submission.id),
+            "contestant": str(submission.contestant_id),
+            "problem": submission.problem,
+            "testcase": testcase,
+            "total": total,
+            "status": status.name
+        }, f"{Topic.CONTESTANT}:{submission.contestant_id}")
+
+    
+    def dump(self) -> callable:
+        # Takes what can still change and returns the function building the snapshot of the journal, which
+        # runs in its thread. Judged submissions never change, only how many there are is taken here.
+        # The source code of the submissions is not kept
+        contest = {
+            "progress": self.progress.name,
+            "duration": self.duration,
+            "elapsed": self.elapsed,
+            "started_at": self.started_at,
+            "problems": [problem.name for problem in self.problems],
+            "languages": self.supported_languages
+        }
+        contestants = [(
+            c, len(c.submissions), c.points, c.last_accepted, c.finished,
+            {problem: status.name for problem, status in c.state.items()}
+        ) for c in self.contestants.values()]
+        
+        def build() -> dict:
+            return {**contest, "contestants": [{
+                "id": str(c.id),
+                "name": c.name,
+                "color": c.color,
+                "points": points,
+                "last_accepted": last_accepted,
+                "finished": finished,
+                "state": state,
+                "submissions": [[str(s.id), s.problem, s.language, s.time, s.status.name] for s in c.submissions[:count]]
+            } for c, count, points, last_accepted, finished, state in contestants]}
+        return build
+    
+    
+    def __problems__(self, names: list[str], problems: dict[str, Problem]) -> list[Problem]:
+        found = [problems[name] for name in names if name in problems]
+        if len(found) < len(names):
+            logger.warning(f"Recovered contest problems not found: {set(names).difference(problems)}")
+        return found
+    
+    
+    def load(self, data: dict, problems: dict[str, Problem]):
+        # Restores a snapshot built by dump() into a new contest, without broadcasting anything
+        self.progress = ContestProgress[data["progress"]]
+        self.duration = data["duration"]
+        self.elapsed = data["elapsed"]
+        self.started_at = data["started_at"]
+        self.problems = self.__problems__(data["problems"], problems)
+        self.problem_index = {p.name: p for p in self.problems}
+        self.supported_languages = data["languages"]
+        for item in data["contestants"]:
+            c = Contestant(item["name"], item["color"])
+            c.id = UUID(item["id"])
+            c.points = item["points"]
+            c.last_accepted = item["last_accepted"]
+            c.finished = item["finished"]
+            c.score = c.points - c.finished
+            c.state = {problem: SubmissionStatus[status] for problem, status in item["state"].items()}
+            for sid, problem, language, submitted, status in item["submissions"]:
+                submission = Submission(c.id, problem, language, submitted, b"")
+                submission.id = UUID(sid)
+                submission.status = SubmissionStatus[status]
+                c.submissions.append(submission)
+            self.contestants[c.id] = c
+            self.ranking.update(c)
+        self.version += 1
+    
+    
+    def apply(self, record: dict, problems: dict[str, Problem]):
+        # Replays a journal record, without broadcasting it
+        event = record["e"]
+        if event == "add":
+            c = Contestant(record["name"], record["color"])
+            c.id = UUID(record["id"])
+            self.contestants[c.id] = c
+            self.ranking.update(c)
+        elif event == "start":
+            self.duration = record["duration"]
+            self.started_at = record["started_at"]
+            self.problems = self.__problems__(record["problems"], problems)
+            self.problem_index = {p.name: p for p in self.problems}
+            self.supported_languages = record["languages"]
+            self.progress = ContestProgress.IN_PROGRESS
+            for c in self.contestants.values():
+                c.state = {name: SubmissionStatus.PENDING for name in record["problems"]}
+        elif event == "verdict":
+            c = self.contestants[UUID(record["contestant"])]
+            submission = Submission(c.id, record["problem"], record["language"], record["time"], b"")
+            submission.id = UUID(record["id"])
+            submission.status = SubmissionStatus[record["status"]]
+            c.add_submission(submission)
+            self.ranking.update(c)
+        elif event == "finish":
+            c = self.contestants[UUID(record["contestant"])]
+            c.mark_finished(record["time"])
+            self.ranking.update(c)
+        elif event == "stop":
+            self.elapsed = record["elapsed"]
+            self.progress = ContestProgress.FINISHED
+        self.version += 1
@@ -13,6 +13,7 @@ class Submission:
         self.time: int = time
         self.code: bytes = code
         self.status: SubmissionStatus = SubmissionStatus.PENDING
+        self.message: Optional[str] = None
 
 
 class Contestant:
@@ -21,6 +22,9 @@ class Contestant:
         self.id: UUID = uuid4()
         self.color: Optional[str] = color
         self.score: int = 0
+        # Score of the verdicts alone, the finish time is taken off when finished
+        self.points: int = 0
+        self.last_accepted: int = 0
         self.finished: int = 0
         self.state: dict[str, SubmissionStatus] = {}
         self.submissions: list[Submission] = []
@@ -29,19 +33,19 @@ class Contestant:
         if self.finished > 0:
             return
         if time is None:
-            time = 0
-            for sub in self.submissions:
-                if sub.status is SubmissionStatus.ACCEPTED:
-                    time = max(time, sub.time)
+            time = self.last_accepted
         self.finished = time
+        self.score = self.points - self.finished
     
     def refresh_score(self) -> int:
+        # Full recount, the score is otherwise kept up to date by add_submission and mark_finished
         _sum = 0
         for sub in self.submissions:
             if sub.status is SubmissionStatus.ACCEPTED:
                 _sum += 2000
             elif sub.status not in (SubmissionStatus.INTERNAL_ERROR, SubmissionStatus.PENDING):
                 _sum -= 100
+        self.points = _sum
         if self.finished > 0:
             _sum -= self.finished
         self.score = _sum
@@ -55,6 +59,12 @@ class Contestant:
         if self.state[submission.problem] is not SubmissionStatus.ACCEPTED:
             self.state[submission.problem] = submission.status
             self.submissions.append(submission)
+            if submission.status is SubmissionStatus.ACCEPTED:
+                self.points += 2000
+                self.last_accepted = max(self.last_accepted, submission.time)
+            elif submission.status is not SubmissionStatus.INTERNAL_ERROR:
+                self.points -= 100
+            self.score = self.points - self.finished
         mark_finish = True
         for key in self.state:
             if self.state[key] is not SubmissionStatus.ACCEPTED:
@@ -0,0 +1,174 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+LOG = "contest.log"
+SNAPSHOT = "contest.snapshot.json"
+
+
+def __fsync_directory__(path: str):
+    # Makes a rename durable
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Write-ahead log of the contest. Every change of the state is appended as a JSON line, numbered, and
+# encoded and written by a thread: whatever queued up while the previous batch was written goes out with
+# a single fsync, so the event loop never waits for the disk. Every JOURNAL_SNAPSHOT_EVERY records the whole
+# contest is written aside and the log starts over, recovery loads the snapshot and replays the rest
+class ContestJournal:
+    def __init__(self, directory: str):
+        self.directory: str = directory
+        self.log_path: str = os.path.join(directory, LOG)
+        self.snapshot_path: str = os.path.join(directory, SNAPSHOT)
+        self.snapshot_every: int = int(os.getenv("JOURNAL_SNAPSHOT_EVERY", 20000))
+        # Number of the last record, records up to the one in the snapshot are skipped on recovery
+        self.seq: int = 0
+        # Records appended since the last snapshot
+        self.pending: int = 0
+        self.written: int = 0
+        self.batches: int = 0
+        self.snapshots: int = 0
+        self.failed: int = 0
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        os.makedirs(directory, exist_ok=True)
+    
+    
+    def recover(self) -> tuple[Optional[dict], list[dict]]:
+        # Returns the contest of the last snapshot (None when there is none) and the records after it.
+        # A record torn by a crash ends the log, it is cut off so the next records follow the good ones
+        data = None
+        try:
+            with open(self.snapshot_path, "r") as file:
+                snapshot = json.load(file)
+            self.seq = snapshot["seq"]
+            data = snapshot["contest"]
+        except FileNotFoundError:
+            pass
+        records = []
+        good = 0
+        try:
+            with open(self.log_path, "rb") as file:
+                content = file.read()
+        except FileNotFoundError:
+            content = b""
+        while good < len(content):
+            end = content.find(b"\n", good)
+            if end < 0:
+                break
+            try:
+                record = json.loads(content[good:end])
+            except ValueError:
+                break
+            good = end + 1
+            if record["n"] <= self.seq:
+                # Already in the snapshot, the log was not cut off after it
+                continue
+            self.seq = record["n"]
+            records.append(record)
+        if good < len(content):
+            logger.warning(f"Cut off {len(content) - good} bytes of a torn record at the end of the contest journal")
+            with open(self.log_path, "r+b") as file:
+                file.truncate(good)
+                os.fsync(file.fileno())
+        self.pending = len(records)
+        return data, records
+    
+    
+    def start(self):
+        self._thread = threading.Thread(target=self.__writer__, name="contest-journal", daemon=True)
+        self._thread.start()
+    
+    
+    def append(self, record: dict) -> bool:
+        # Returns True when a snapshot is due
+        self.seq += 1
+        record["n"] = self.seq
+        # Owned by the writer from here on
+        self._queue.put(record)
+        self.pending += 1
+        return self.pending >= self.snapshot_every > 0
+    
+    
+    def snapshot(self, build: Optional[callable]):
+        # build returns the contest as of the last record, it is called by the writer. None starts a new contest
+        self.pending = 0
+        self._queue.put((self.seq, build))
+    
+    
+    def reset(self):
+        self.snapshot(None)
+    
+    
+    def close(self):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+    
+    
+    def __writer__(self):
+        with open(self.log_path, "ab") as log:
+            while True:
+                batch = [self._queue.get()]
+                try:
+                    while True:
+                        batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    pass
+                lines = []
+                for item in batch:
+                    if isinstance(item, dict):
+                        lines.append(json.dumps(item, separators=(",", ":")))
+                        continue
+                    # Records before a snapshot reach the log first, it is only cut off once the snapshot is safe
+                    self.__flush__(log, lines)
+                    lines = []
+                    if item is None:
+                        return
+                    self.__write_snapshot__(log, *item)
+                self.__flush__(log, lines)
+    
+    
+    def __flush__(self, log, lines: list[str]):
+        if not lines:
+            return
+        try:
+            log.write(("\n".join(lines) + "\n").encode())
+            log.flush()
+            os.fsync(log.fileno())
+            self.written += len(lines)
+            self.batches += 1
+        except Exception as e:
+            self.failed += len(lines)
+            logger.error(f"Failed to write {len(lines)} records to the contest journal: {e}")
+    
+    
+    def __write_snapshot__(self, log, seq: int, build: Optional[callable]):
+        started = time.monotonic()
+        temp = f"{self.snapshot_path}.tmp"
+        try:
+            data = build() if build else None
+            with open(temp, "w") as file:
+                json.dump({"seq": seq, "contest": data}, file, separators=(",", ":"))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp, self.snapshot_path)
+            __fsync_directory__(self.directory)
+            log.truncate(0)
+            os.fsync(log.fileno())
+            self.snapshots += 1
+            logger.info(f"Contest journal compacted in {(time.monotonic() - started) * 1000:.0f}ms")
+        except Exception as e:
+            logger.error(f"Failed to write the contest snapshot: {e}")
@@ -1,41 +1,174 @@
+import hashlib
+import json
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 logger = logging.getLogger(__name__)
 
+# name -> {"size", "mtime", "hash", "version", "testcases"}, so warm starts never hash unchanged statements
+MANIFEST = "problems/.manifest.json"
+CHUNK_SIZE = 1024 * 1024
+
 
 class Problem:
-    def __init__(self, name: str, content: bytes):
+    def __init__(self, name: str, version: str, path: str, stat: os.stat_result, digest: str, testcases: int):
         self.name: str = name
-        self.content: bytes = content
+        # Changes whenever the testdata of the problem changes
+        self.version: str = version
+        # The statement is served straight from the file, the ETag changes only with its content
+        self.path: str = path
+        self.stat: os.stat_result = stat
+        self.digest: str = digest
+        self.etag: str = f'"{digest[:32]}"'
+        self.testcases: int = testcases
+
+
+def __testdata_version__(path: str) -> tuple[str, int]:
+    # Returns the version and the number of testcases (input/output files sharing a name count once)
+    digest = hashlib.sha256()
+    files = [f"{path}/config.cfg"]
+    if os.path.isdir(f"{path}/testcases"):
+        files.extend(entry.path for entry in os.scandir(f"{path}/testcases") if entry.is_file())
+    for file in sorted(files):
+        try:
+            stat = os.stat(file)
+        except FileNotFoundError:
+            continue
+        digest.update(f"{os.path.basename(file)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    testcases = {os.path.splitext(os.path.basename(file))[0] for file in files[1:]}
+    return digest.hexdigest()[:16], len(testcases)
 
 
-def __problem_loader__(name: str) -> Problem:
+def __hash_file__(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def __scan_problem__(name: str, cached: Optional[dict]) -> tuple[dict, os.stat_result]:
+    # Thread safe, returns the manifest entry and the stat of the statement
     path = f"problems/{name}"
-    if not os.path.isdir(path):
-        raise FileNotFoundError(f"Problem {name} not found")
-    file = open(f"problems/{name}/content.pdf", "rb")
-    content: bytes = file.read()
-    return Problem(name, content)
+    stat = os.stat(f"{path}/content.pdf")
+    if cached and cached.get("size", None) == stat.st_size and cached.get("mtime", None) == stat.st_mtime_ns:
+        digest = cached["hash"]
+    else:
+        digest = __hash_file__(f"{path}/content.pdf")
+    version, testcases = __testdata_version__(path)
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "hash": digest,
+        "version": version,
+        "testcases": testcases
+    }, stat
+
+
+def __try_scan__(name: str, cached: Optional[dict]) -> Optional[tuple[dict, os.stat_result]]:
+    try:
+        return __scan_problem__(name, cached)
+    except Exception as e:
+        logger.error(f"Failed to load problems {name}: {e}")
+        return None
+
+
+def __read_manifest__() -> dict[str, dict]:
+    try:
+        with open(MANIFEST, "r") as file:
+            manifest = json.load(file)
+        return manifest if isinstance(manifest, dict) else {}
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning(f"Ignored the problem manifest: {e}")
+        return {}
+
+
+def __write_manifest__(manifest: dict[str, dict]):
+    # Written aside and renamed, several processes may load the problems at the same time
+    temp = f"{MANIFEST}.{os.getpid()}.tmp"
+    try:
+        with open(temp, "w") as file:
+            json.dump(manifest, file, separators=(",", ":"))
+        os.replace(temp, MANIFEST)
+    except Exception as e:
+        logger.warning(f"Failed to write the problem manifest: {e}")
 
 
 class ProblemManager:
     def __init__(self):
         self.problems: dict[str, Problem] = {}
+        self.manifest: dict[str, dict] = {}
         
         if not os.path.exists("problems"):
             os.mkdir("problems")
-        count = 0
-        for entry in os.scandir("problems"):
-            try:
-                if not entry.is_dir():
-                    continue
-                if entry.name.startswith("."):
-                    continue
-                problem = __problem_loader__(entry.name)
-                self.problems[entry.name] = problem
-                count += 1
-            except Exception as e:
-                logger.error(f"Failed to load problems {entry.name}: {e}")
-        logger.info(f"Loaded {count} problems")
-        
\ No newline at end of file
+        started = time.monotonic()
+        cached = __read_manifest__()
+        names = [entry.name for entry in os.scandir("problems") if entry.is_dir() and not entry.name.startswith(".")]
+        with ThreadPoolExecutor(max_workers=int(os.getenv("PROBLEM_SCAN_WORKERS", 8))) as pool:
+            results = list(pool.map(lambda name: __try_scan__(name, cached.get(name, None)), names))
+        for name, result in zip(names, results):
+            if result is None:
+                continue
+            entry, stat = result
+            self.manifest[name] = entry
+            self.problems[name] = Problem(
+                name, entry["version"], os.path.abspath(f"problems/{name}/content.pdf"), stat,
+                entry["hash"], entry["testcases"]
+            )
+        hashed = sum(
+            1 for name, entry in self.manifest.items()
+            if (cached.get(name, None) or {}).get("mtime", None) != entry["mtime"]
+            or (cached.get(name, None) or {}).get("size", None) != entry["size"]
+        )
+        if self.manifest != cached:
+            __write_manifest__(self.manifest)
+        logger.info(f"Loaded {len(self.problems)} problems in {time.monotonic() - started:.2f}s, {hashed} statements hashed")
+    
+    
+    def get_version(self, name: str) -> Optional[str]:
+        problem = self.problems.get(name, None)
+        return problem.version if problem else None
+    
+    
+    def scan(self, name: str) -> Optional[tuple[dict, os.stat_result]]:
+        # Thread safe, None when the problem is gone. The result is applied with update()
+        if not os.path.isdir(f"problems/{name}"):
+            return None
+        return __scan_problem__(name, self.manifest.get(name, None))
+    
+    
+    def update(self, name: str, result: Optional[tuple[dict, os.stat_result]]) -> Optional[str]:
+        # Adds, updates or retires a single problem, returns what happened or None when nothing changed.
+        # Updated problems are changed in place, so a running contest serves the new statement as well
+        problem = self.problems.get(name, None)
+        if result is None:
+            if problem is None:
+                return None
+            del self.problems[name]
+            self.manifest.pop(name, None)
+            state = "removed"
+        else:
+            entry, stat = result
+            if problem is not None and self.manifest.get(name, None) == entry:
+                return None
+            self.manifest[name] = entry
+            if problem is None:
+                self.problems[name] = Problem(
+                    name, entry["version"], os.path.abspath(f"problems/{name}/content.pdf"), stat,
+                    entry["hash"], entry["testcases"]
+                )
+                state = "added"
+            else:
+                problem.version = entry["version"]
+                problem.stat = stat
+                problem.digest = entry["hash"]
+                problem.etag = f'"{entry["hash"][:32]}"'
+                problem.testcases = entry["testcases"]
+                state = "updated"
+        __write_manifest__(self.manifest)
+        return state
@@ -0,0 +1,92 @@
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Optional
+from uuid import UUID
+
+from managers.data import Submission
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after: int, per_contestant: bool):
+        super().__init__("Too many pending submissions" if per_contestant else "Judging queue is full")
+        self.retry_after: int = retry_after
+        self.per_contestant: bool = per_contestant
+
+
+class QueueItem:
+    def __init__(self, submission: Submission, callback: callable, progress: Optional[callable] = None):
+        self.submission: Submission = submission
+        self.callback: callable = callback
+        self.progress: Optional[callable] = progress
+        self.enqueued_at: float = time.monotonic()
+
+
+# Bounded submission queue, fair across contestants: every contestant has its own
+# FIFO (ordered by contest time) and the queues are served round-robin
+class SubmissionQueue:
+    def __init__(self, max_size: int, max_per_contestant: int):
+        self.max_size: int = max_size
+        self.max_per_contestant: int = max_per_contestant
+        self.size: int = 0
+        self.total_enqueued: int = 0
+        self.total_rejected: int = 0
+        self.total_dispatched: int = 0
+        self.total_wait: float = 0.0
+        self.max_wait: float = 0.0
+        self.recent_wait: float = 0.0
+        self.dispatched: dict[UUID, int] = {}
+        self._queues: dict[UUID, deque[QueueItem]] = {}
+        self._order: deque[UUID] = deque()
+        self._available = asyncio.Semaphore(0)
+    
+    
+    def put(self, item: QueueItem):
+        contestant_id = item.submission.contestant_id
+        queue = self._queues.get(contestant_id, None)
+        if queue is not None and len(queue) >= self.max_per_contestant:
+            self.total_rejected += 1
+            raise QueueFullError(self.retry_after(), per_contestant=True)
+        if self.size >= self.max_size:
+            self.total_rejected += 1
+            raise QueueFullError(self.retry_after(), per_contestant=False)
+        if queue is None:
+            queue = self._queues[contestant_id] = deque()
+            self._order.append(contestant_id)
+        queue.append(item)
+        self.size += 1
+        self.total_enqueued += 1
+        self._available.release()
+    
+    
+    async def get(self) -> QueueItem:
+        await self._available.acquire()
+        contestant_id = self._order.popleft()
+        queue = self._queues[contestant_id]
+        item = queue.popleft()
+        if queue:
+            self._order.append(contestant_id)
+        else:
+            del self._queues[contestant_id]
+        self.size -= 1
+        
+        wait = time.monotonic() - item.enqueued_at
+        self.total_dispatched += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.recent_wait = wait if self.total_dispatched == 1 else 0.8 * self.recent_wait + 0.2 * wait
+        self.dispatched[contestant_id] = self.dispatched.get(contestant_id, 0) + 1
+        return item
+    
+    
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.recent_wait))
+    
+    
+    def average_wait(self) -> float:
+        return self.total_wait / self.total_dispatched if self.total_dispatched else 0.0
+    
+    
+    def pending(self) -> dict[UUID, int]:
+        return {contestant_id: len(queue) for contestant_id, queue in self._queues.items()}
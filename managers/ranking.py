@@ -0,0 +1,53 @@
+import math
+from bisect import bisect_left, insort
+
+from managers.data import Contestant
+
+
+# Contestants ordered by score, then by finish time (earlier first, unfinished last). The keys are kept
+# sorted, so a score change is two binary searches and the rank of anyone is one more. Contestants with
+# the same score and finish time share the same rank
+class Ranking:
+    def __init__(self):
+        self.keys: list[tuple[int, float, str]] = []
+        self.members: dict[str, tuple[tuple[int, float, str], Contestant]] = {}
+    
+    
+    def __len__(self) -> int:
+        return len(self.keys)
+    
+    
+    @staticmethod
+    def __key__(contestant: Contestant) -> tuple[int, float, str]:
+        return -contestant.score, contestant.finished or math.inf, str(contestant.id)
+    
+    
+    def update(self, contestant: Contestant):
+        key = self.__key__(contestant)
+        member = self.members.get(key[2], None)
+        if member is not None:
+            if member[0] == key:
+                return
+            del self.keys[bisect_left(self.keys, member[0])]
+        insort(self.keys, key)
+        self.members[key[2]] = (key, contestant)
+    
+    
+    def rank(self, uid: str) -> int:
+        member = self.members.get(uid, None)
+        if member is None:
+            return 0
+        # The shortened key sorts before every full key with the same score and finish time
+        return bisect_left(self.keys, member[0][:2]) + 1
+    
+    
+    def page(self, offset: int = 0, limit: int = -1) -> list[tuple[int, Contestant]]:
+        keys = self.keys[offset:] if limit < 0 else self.keys[offset:offset + limit]
+        result = []
+        for index, key in enumerate(keys, offset):
+            # Ties are rare, only walk back to the first of the group when the previous key is equal
+            rank = index + 1
+            if index > 0 and self.keys[index - 1][:2] == key[:2]:
+                rank = bisect_left(self.keys, key[:2]) + 1
+            result.append((rank, self.members[key[2]][1]))
+        return result
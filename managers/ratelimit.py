@@ -0,0 +1,114 @@
+import math
+import os
+import time
+from typing import Optional
+from uuid import UUID
+
+
+class RateLimitError(Exception):
+    def __init__(self, retry_after: int, per_contestant: bool):
+        super().__init__("Too many submissions" if per_contestant else "Too many submissions on the server")
+        self.retry_after: int = retry_after
+        self.per_contestant: bool = per_contestant
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate: float = rate
+        self.burst: int = burst
+        self.tokens: float = burst
+        self.updated: float = time.monotonic()
+    
+    
+    def __refill__(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    
+    def wait(self, now: float) -> float:
+        # Seconds until a token is available, without taking it
+        self.__refill__(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+    
+    
+    def take(self):
+        self.tokens -= 1
+
+
+# Token buckets checked before a submission is read and created: one per contestant and one for the whole
+# server. A submission takes a token from both once it is queued, a rejected one takes none
+class SubmissionLimiter:
+    def __init__(self):
+        # Largest accepted source code
+        self.max_source: int = int(os.getenv("MAX_SOURCE_KB", 64)) * 1024
+        # Per contestant: SUBMIT_RATE submissions per minute, up to SUBMIT_BURST in a row. 0 disables
+        self.rate: float = float(os.getenv("SUBMIT_RATE", 6)) / 60
+        self.burst: int = int(os.getenv("SUBMIT_BURST", 3))
+        # Whole server: SUBMIT_GLOBAL_RATE submissions per second, up to SUBMIT_GLOBAL_BURST in a row. 0 disables
+        self.global_rate: float = float(os.getenv("SUBMIT_GLOBAL_RATE", 20))
+        self.global_burst: int = int(os.getenv("SUBMIT_GLOBAL_BURST", 100))
+        self.buckets: dict[UUID, TokenBucket] = {}
+        self.server: Optional[TokenBucket] = TokenBucket(self.global_rate, self.global_burst) if self.global_rate > 0 else None
+        self.limited: int = 0
+    
+    
+    def __bucket__(self, uid: UUID) -> Optional[TokenBucket]:
+        if self.rate <= 0:
+            return None
+        bucket = self.buckets.get(uid, None)
+        if bucket is None:
+            bucket = self.buckets[uid] = TokenBucket(self.rate, self.burst)
+        return bucket
+    
+    
+    def check(self, uid: UUID):
+        # Raises RateLimitError with the seconds to wait, nothing is taken
+        now = time.monotonic()
+        for limit, per_contestant in ((self.__bucket__(uid), True), (self.server, False)):
+            if limit is None:
+                continue
+            wait = limit.wait(now)
+            if wait > 0:
+                self.limited += 1
+                raise RateLimitError(math.ceil(wait), per_contestant)
+    
+    
+    def take(self, uid: UUID):
+        # After a successful check, once the submission is accepted
+        bucket = self.__bucket__(uid)
+        if bucket:
+            bucket.take()
+        if self.server:
+            self.server.take()
+    
+    
+    def limits(self) -> dict:
+        # Static part, for the clients
+        return {"max_source": self.max_source, "rate": round(self.rate * 60, 2), "burst": self.burst}
+    
+    
+    def status(self, uid: UUID) -> tuple[int, int]:
+        # Submissions the contestant can make right now and the seconds until the next one
+        bucket = self.__bucket__(uid)
+        if bucket is None:
+            return -1, 0
+        wait = bucket.wait(time.monotonic())
+        return int(bucket.tokens), math.ceil(wait)
+    
+    
+    def get_bucket(self, uid: UUID) -> Optional[tuple[float, float]]:
+        # The state of a bucket, copied to the workers so they answer the status themselves
+        bucket = self.buckets.get(uid, None)
+        return (bucket.tokens, bucket.updated) if bucket else None
+    
+    
+    def set_bucket(self, uid: UUID, state: Optional[tuple[float, float]]):
+        bucket = self.__bucket__(uid)
+        if bucket is not None and state is not None:
+            bucket.tokens, bucket.updated = state
+    
+    
+    def clear(self):
+        self.buckets.clear()
@@ -1,28 +1,85 @@
+import json
 import logging
+import os
+import time
+from collections import deque
 from typing import Optional
 
 import aiohttp
 import asyncio
 
+from managers.cache import VerdictCache
 from managers.data import Submission
+from managers.queue import QueueItem, SubmissionQueue
 from uuid import uuid4, UUID
 
 from utils.enums import SubmissionStatus
 
 logger = logging.getLogger(__name__)
 
+VERDICTS: dict[str, SubmissionStatus] = {
+    status.name: status for status in SubmissionStatus if status is not SubmissionStatus.PENDING
+}
+
+
+def __parse_status__(status: Optional[str], message: Optional[str] = None) -> SubmissionStatus:
+    if status not in VERDICTS:
+        raise ValueError(f"Unknown response status: {status}" + (". Message: " + message if message else ""))
+    return VERDICTS[status]
+
 
 class Sandbox:
-    def __init__(self, url: str):
+    def __init__(self, url: str, slots: int = 1, fixed_slots: bool = False, on_change: Optional[callable] = None):
         self.id = uuid4()
         self.url = url
         self.session = aiohttp.ClientSession(base_url=url, timeout=aiohttp.ClientTimeout(total=30))
-        self.lock = asyncio.Lock()
         self.version: Optional[str] = None
+        self.capabilities: dict = {}
         self.supported_modules: set[str] = set()
         self.supported_problems: set[str] = set()
         self.ready: bool = False
+        # Number of submissions the node may judge at the same time. A value
+        # set in sandboxes.txt takes precedence over the one the node reports
+        self.slots: int = max(1, slots)
+        self.fixed_slots: bool = fixed_slots
+        self.in_flight: int = 0
         self.in_queue: int = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        # Called whenever the readiness, the capabilities or the slots of the node change
+        self.on_change: Optional[callable] = on_change
+        
+        # Health probing, independent of the judging slots
+        self.probe_timeout = aiohttp.ClientTimeout(total=float(os.getenv("HEALTH_TIMEOUT", 3)))
+        self.healthy_interval: float = float(os.getenv("HEALTH_INTERVAL", 30))
+        self.degraded_interval: float = float(os.getenv("HEALTH_INTERVAL_DEGRADED", 2))
+        self.backoff_max: float = float(os.getenv("HEALTH_BACKOFF_MAX", 60))
+        self.probe_failures: int = 0
+        self.stream_timeout = aiohttp.ClientTimeout(total=None, sock_connect=10,
+                                                    sock_read=float(os.getenv("JOB_IDLE_TIMEOUT", 60)))
+        self.stop_on_failure: bool = os.getenv("JUDGE_STOP_ON_FAILURE", "1") == "1"
+        
+        # Recent judging times (seconds, from the moment a slot was acquired) used for hedging
+        self.latencies: deque[float] = deque(maxlen=200)
+        self._p95: Optional[float] = None
+        
+        # Coalescing of submissions into batch requests, for nodes advertising "batch"
+        self.batch_window: float = float(os.getenv("BATCH_WINDOW_MS", 5)) / 1000
+        self.batches: int = 0
+        self.batched: int = 0
+        self._batch: list[tuple[Submission, asyncio.Future]] = []
+        self._batch_timer: Optional[asyncio.TimerHandle] = None
+        self._wake = asyncio.Event()
+        
+        # Circuit breaker fed by submit failures. Once open the node gets no submission for a cooldown that
+        # doubles every time it opens again, then a single trial submission decides whether it closes
+        self.breaker_threshold: int = int(os.getenv("BREAKER_THRESHOLD", 3))
+        self.breaker_cooldown: float = float(os.getenv("BREAKER_COOLDOWN", 10))
+        self.breaker_cooldown_max: float = float(os.getenv("BREAKER_COOLDOWN_MAX", 300))
+        self.breaker_open: bool = False
+        self.breaker_until: float = 0.0
+        self.breaker_trips: int = 0
+        self._trial: bool = False
+        self.failures: int = 0
         self._task = asyncio.create_task(self.__connect__())
         
     
@@ -31,116 +88,419 @@ class Sandbox:
         asyncio.create_task(self.session.close())
         
     
+    @property
+    def load(self) -> float:
+        return (self.in_flight + self.in_queue) / self.slots
+    
+    
+    def set_slots(self, slots: int):
+        self.slots = max(1, slots)
+        self.__wake__()
+        
+    
+    async def __acquire__(self):
+        if self.in_flight < self.slots and not self._waiters:
+            self.in_flight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        self.in_queue += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been handed over right before the cancellation
+            if future.done() and not future.cancelled():
+                self.__release__()
+            raise
+        finally:
+            self.in_queue -= 1
+            
+    
+    def __release__(self):
+        self.in_flight -= 1
+        self.__wake__()
+        
+    
+    def __wake__(self):
+        while self._waiters and self.in_flight < self.slots:
+            future = self._waiters.popleft()
+            if future.done():
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+        
+    
+    @property
+    def available(self) -> bool:
+        return self.ready and not self.breaker_open
+    
+    
+    def admit(self) -> bool:
+        # Whether a submission may be routed to the node. While the breaker is half-open the first
+        # caller gets the trial and everyone else is turned away until it finishes
+        if not self.ready:
+            return False
+        if not self.breaker_open:
+            return True
+        if self._trial or time.monotonic() < self.breaker_until:
+            return False
+        self._trial = True
+        return True
+    
+    
+    @property
+    def idle_slot(self) -> bool:
+        return self.in_flight < self.slots
+    
+    
+    def latency_p95(self, min_samples: int) -> Optional[float]:
+        if len(self.latencies) < min_samples:
+            return None
+        if self._p95 is None:
+            ordered = sorted(self.latencies)
+            self._p95 = ordered[int(0.95 * (len(ordered) - 1))]
+        return self._p95
+    
+    
+    def wake(self):
+        # Run the next health probe right away
+        self._wake.set()
+        
+    
+    def record_success(self, trial: bool = False):
+        self.failures = 0
+        if trial and self.breaker_open:
+            logger.info(f"Sandbox {self.id} passed its trial submission, resuming routing")
+            self.breaker_open = False
+            self.breaker_trips = 0
+        
+    
+    def record_failure(self, trial: bool = False):
+        self.failures += 1
+        if not trial and (self.breaker_open or self.failures < self.breaker_threshold):
+            return
+        # A passing health probe says nothing about /submit, only the trial submission closes the breaker
+        self.breaker_trips += 1
+        cooldown = min(self.breaker_cooldown_max, self.breaker_cooldown * 2 ** (self.breaker_trips - 1))
+        self.breaker_open = True
+        self.breaker_until = time.monotonic() + cooldown
+        logger.error(f"Sandbox {self.id} failed {self.failures} submissions in a row, pulled from routing for {cooldown:.0f}s")
+        
+    
+    def __next_interval__(self) -> float:
+        if not self.ready:
+            # Exponential backoff while the node is down
+            return min(self.backoff_max, self.degraded_interval * 2 ** max(0, self.probe_failures - 1))
+        if self.breaker_open or self.failures > 0:
+            return self.degraded_interval
+        return self.healthy_interval
+        
+    
+    async def __fetch__(self, path: str, optional: bool = False):
+        async with self.session.get(path, timeout=self.probe_timeout) as resp:
+            if optional and resp.status == 404:
+                return None
+            if resp.status != 200:
+                raise ValueError(f"Response {resp.status} from {path}")
+            if path == "/version":
+                return await resp.text()
+            return await resp.json()
+        
+    
+    async def __probe__(self):
+        was_ready = self.ready
+        was_slots = self.slots
+        modules: set[str] = set()
+        problems: set[str] = set()
+        try:
+            version, data_modules, data_problems, capabilities = await asyncio.gather(
+                self.__fetch__("/version"),
+                self.__fetch__("/modules"),
+                self.__fetch__("/problems"),
+                # Optional endpoint, older nodes do not implement it
+                self.__fetch__("/capabilities", optional=True)
+            )
+            for data, target in ((data_modules, modules), (data_problems, problems)):
+                if not isinstance(data, list):
+                    raise ValueError("Response does not match the expected format")
+                for item in data:
+                    if not isinstance(item, str):
+                        raise ValueError("Response does not match the expected format")
+                    target.add(item)
+            if capabilities is not None and not isinstance(capabilities, dict):
+                raise ValueError("Response does not match the expected format")
+            
+            self.version = version
+            self.capabilities = capabilities or {}
+            if not isinstance(self.capabilities.get("batch", 0), int):
+                self.capabilities["batch"] = 0
+            slots = self.capabilities.get("slots", None)
+            if isinstance(slots, int) and slots > 0 and not self.fixed_slots and slots != self.slots:
+                logger.info(f"Sandbox {self.id} reported {slots} judging slots")
+                self.set_slots(slots)
+            if not self.ready:
+                logger.info(f"Connected to sandbox {self.id}({self.url}). Version: {self.version}")
+            self.ready = True
+            self.probe_failures = 0
+        except Exception as e:
+            self.version = None
+            self.capabilities = {}
+            if self.ready:
+                logger.error(f"Lost connection to sandbox {self.id}: {e or type(e).__name__}")
+            self.ready = False
+            self.probe_failures += 1
+        changed = was_ready != self.ready or was_slots != self.slots \
+            or modules != self.supported_modules or problems != self.supported_problems
+        self.supported_modules = modules
+        self.supported_problems = problems
+        if changed and self.on_change:
+            self.on_change(self)
+        
+    
     async def __connect__(self):
         while True:
-            async with self.lock:
-                try:
-                    async with self.session.get("/version") as resp:
-                        self.version = await resp.text()
-                        
-                    async with self.session.get("/modules") as resp:
-                        data = await resp.json()
-                        if not isinstance(data, list):
-                            raise ValueError("Response does not match the expected format")
-                        for item in data:
-                            if not isinstance(item, str):
-                                raise ValueError("Response does not match the expected format")
-                            self.supported_modules.add(item)
-                            
-                    async with self.session.get("/problems") as resp:
-                        data = await resp.json()
-                        if not isinstance(data, list):
-                            raise ValueError("Response does not match the expected format")
-                        for item in data:
-                            if not isinstance(item, str):
-                                raise ValueError("Response does not match the expected format")
-                            self.supported_problems.add(item)
-                        
-                    if not self.ready:
-                        logger.info(f"Connected to sandbox {self.id}({self.url}). Version: {self.version}")
-                    self.ready = True
-                except Exception as e:
-                    self.version = None
-                    self.supported_modules.clear()
-                    self.supported_problems.clear()
-                    if self.ready:
-                        logger.error(f"Lost connection to sandbox {self.id}: {e}")
-                    self.ready = False
-            await asyncio.sleep(30)
+            await self.__probe__()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.__next_interval__())
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
             
     
-    async def submit(self, submission: Submission):
-        self.in_queue += 1
+    def __form__(self, submission: Submission) -> dict:
+        return {
+            "id": str(submission.id),
+            "problem_id": submission.problem,
+            "target_module": submission.language,
+            "file": submission.code
+        }
+        
+    
+    async def __submit_once__(self, submission: Submission) -> tuple[SubmissionStatus, Optional[str]]:
+        async with self.session.post("/submit", data=self.__form__(submission)) as resp:
+            if resp.status != 200:
+                raise ValueError(f"Response {resp.status} from sandbox")
+            data = await resp.json()
+            return __parse_status__(data.get("status", None), data.get("message", None)), data.get("message", None)
+        
+    
+    async def __submit_job__(self, submission: Submission, progress: Optional[callable]) -> tuple[SubmissionStatus, Optional[str]]:
+        async with self.session.post("/jobs", data=self.__form__(submission)) as resp:
+            if resp.status not in (200, 202):
+                raise ValueError(f"Response {resp.status} from sandbox")
+            job_id = (await resp.json()).get("job_id", None)
+            if not isinstance(job_id, str):
+                raise ValueError("Response does not match the expected format")
+        
+        finished = False
         try:
-            async with self.lock:
-                if not self.ready:
-                    submission.status = SubmissionStatus.INTERNAL_ERROR
-                    logger.error("Failed to submit to sandbox %s: not ready", self.id)
-                    return
-                async with self.session.post("/submit", data={
-                    "id": str(submission.id),
-                    "problem_id": submission.problem,
-                    "target_module": submission.language,
-                    "file": submission.code
-                }) as resp:
-                    if resp.status != 200:
-                        submission.status = SubmissionStatus.INTERNAL_ERROR
-                        raise ValueError(f"Response {resp.status} from sandbox")
-                    
-                    data = await resp.json()
-                    status = data.get("status", None)
-                    message = data.get("message", None)
-                    if status == "ACCEPTED":
-                        submission.status = SubmissionStatus.ACCEPTED
-                    elif status == "WRONG_ANSWER":
-                        submission.status = SubmissionStatus.WRONG_ANSWER
-                    elif status == "COMPILATION_ERROR":
-                        submission.status = SubmissionStatus.COMPILATION_ERROR
-                    elif status == "RUNTIME_ERROR":
-                        submission.status = SubmissionStatus.RUNTIME_ERROR
-                    elif status == "TIME_LIMIT_EXCEEDED":
-                        submission.status = SubmissionStatus.TIME_LIMIT_EXCEEDED
-                    elif status == "MEMORY_LIMIT_EXCEEDED":
-                        submission.status = SubmissionStatus.MEMORY_LIMIT_EXCEEDED
-                    elif status == "INTERNAL_ERROR":
-                        submission.status = SubmissionStatus.INTERNAL_ERROR
-                    else:
-                        submission.status = SubmissionStatus.INTERNAL_ERROR
-                        raise ValueError(
-                            f"Unknown response status: {status}" + (". Message: " + message if message else "")
-                        )
-                    (logger.info if submission.status == SubmissionStatus.ACCEPTED else logger.warning)(
-                        "Submission %s finished. Status: %s" + (". Message: " + message if message else ""),
-                        submission.id, submission.status.name
-                    )
+            # No total timeout, only the gap between two events is limited
+            async with self.session.get(f"/jobs/{job_id}/events", timeout=self.stream_timeout) as resp:
+                if resp.status != 200:
+                    raise ValueError(f"Response {resp.status} from sandbox")
+                async for line in resp.content:
+                    if not line.strip():
+                        continue
+                    event = json.loads(line)
+                    if event.get("type", None) == "testcase":
+                        status = __parse_status__(event.get("status", None))
+                        if progress:
+                            await progress(submission, event.get("index", 0), event.get("total", 0), status)
+                        if self.stop_on_failure and status is not SubmissionStatus.ACCEPTED:
+                            # The first failing testcase decides the verdict, the rest of the run is wasted
+                            return status, event.get("message", None)
+                    elif event.get("type", None) == "result":
+                        finished = True
+                        message = event.get("message", None)
+                        return __parse_status__(event.get("status", None), message), message
+                raise ValueError("Job events ended without a result")
+        finally:
+            if not finished:
+                asyncio.create_task(self.__cancel_job__(job_id))
+        
+    
+    async def __submit_batched__(self, submission: Submission) -> tuple[SubmissionStatus, Optional[str]]:
+        future = asyncio.get_running_loop().create_future()
+        self._batch.append((submission, future))
+        if len(self._batch) >= self.capabilities.get("batch", 1):
+            self.__flush_batch__()
+        elif len(self._batch) == 1:
+            self._batch_timer = asyncio.get_running_loop().call_later(self.batch_window, self.__flush_batch__)
+        return await future
+        
+    
+    def __flush_batch__(self):
+        if self._batch_timer:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        items, self._batch = self._batch, []
+        items = [(submission, future) for submission, future in items if not future.done()]
+        if items:
+            asyncio.create_task(self.__send_batch__(items))
+        
+    
+    async def __send_batch__(self, items: list[tuple[Submission, asyncio.Future]]):
+        # Repeated fields, one group per submission, answered with a list of verdicts
+        form = aiohttp.FormData()
+        for submission, _ in items:
+            form.add_field("id", str(submission.id))
+            form.add_field("problem_id", submission.problem)
+            form.add_field("target_module", submission.language)
+            form.add_field("file", submission.code, filename=str(submission.id))
+        self.batches += 1
+        self.batched += len(items)
+        try:
+            async with self.session.post("/submit/batch", data=form) as resp:
+                if resp.status != 200:
+                    raise ValueError(f"Response {resp.status} from sandbox")
+                data = await resp.json()
+                if not isinstance(data, list):
+                    raise ValueError("Response does not match the expected format")
+            results = {item.get("id", None): item for item in data if isinstance(item, dict)}
+            for submission, future in items:
+                if future.done():
+                    continue
+                result = results.get(str(submission.id), None)
+                if result is None:
+                    future.set_exception(ValueError("Submission missing from the batch response"))
+                    continue
+                try:
+                    message = result.get("message", None)
+                    future.set_result((__parse_status__(result.get("status", None), message), message))
+                except ValueError as e:
+                    future.set_exception(e)
+        except Exception as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+        
+    
+    async def __cancel_job__(self, job_id: str):
+        try:
+            async with self.session.delete(f"/jobs/{job_id}", timeout=self.probe_timeout):
+                pass
         except Exception as e:
-            logger.error(f"Failed to submit to sandbox {self.id}: {e}")
+            logger.warning(f"Failed to cancel job {job_id} on sandbox {self.id}: {e or type(e).__name__}")
+        
+    
+    async def submit(self, submission: Submission, progress: Optional[callable] = None,
+                     acquired: Optional[asyncio.Future] = None):
+        # acquired is resolved once a slot is taken, where the judging time starts. Only the trial admitted
+        # while half-open is sent with the breaker open, the submissions queued for a slot before it opened
+        # do not count as one
+        trial = self.breaker_open
+        try:
+            await self.__acquire__()
+        except asyncio.CancelledError:
+            if trial:
+                self._trial = False
+            raise
+        started = time.monotonic()
+        if acquired is not None and not acquired.done():
+            acquired.set_result(None)
+        try:
+            if not self.ready:
+                submission.status = SubmissionStatus.INTERNAL_ERROR
+                logger.error("Failed to submit to sandbox %s: not ready", self.id)
+                return
+            if self.capabilities.get("jobs", False) and (progress or not self.capabilities.get("batch", 0)):
+                submission.status, message = await self.__submit_job__(submission, progress)
+            elif self.capabilities.get("batch", 0) > 1:
+                submission.status, message = await self.__submit_batched__(submission)
+            else:
+                submission.status, message = await self.__submit_once__(submission)
+            submission.message = message
+            self.latencies.append(time.monotonic() - started)
+            self._p95 = None
+            (logger.info if submission.status == SubmissionStatus.ACCEPTED else logger.warning)(
+                "Submission %s finished. Status: %s" + (". Message: " + message if message else ""),
+                submission.id, submission.status.name
+            )
+            self.record_success(trial)
+        except asyncio.CancelledError:
+            # A hedge loser, it ran at least this long. Dropping it would leave out the slow runs
+            self.latencies.append(time.monotonic() - started)
+            self._p95 = None
+            raise
+        except Exception as e:
+            logger.error(f"Failed to submit to sandbox {self.id}: {e or type(e).__name__}")
             submission.status = SubmissionStatus.INTERNAL_ERROR
+            self.record_failure(trial)
+            if isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)):
+                # The node may be gone, do not wait for the next scheduled probe
+                self.wake()
         finally:
-            self.in_queue -= 1
+            if trial:
+                # A cancelled or unsent trial leaves the breaker half-open for the next one
+                self._trial = False
+            self.__release__()
 
 
 class SandboxManager:
-    def __init__(self):
+    def __init__(self, get_problem_version: Optional[callable] = None):
         self.nodes: dict[UUID, Sandbox] = {}
+        # (problem, language) -> ready nodes able to judge it, kept up to date by __reindex__
+        self.index: dict[tuple[str, str], set[Sandbox]] = {}
+        # Number of ready nodes supporting each problem / language
+        self.problems: dict[str, int] = {}
+        self.languages: dict[str, int] = {}
+        self._indexed: dict[UUID, tuple[frozenset[str], frozenset[str]]] = {}
+        # Called when a node becomes available for routing, e.g. to push testdata to it
+        self.on_node_ready: Optional[callable] = None
+        self.default_slots: int = int(os.getenv("SANDBOX_SLOTS", 1))
+        self.queue = SubmissionQueue(
+            max_size=int(os.getenv("DISPATCH_QUEUE_SIZE", 1000)),
+            max_per_contestant=int(os.getenv("DISPATCH_QUEUE_PER_CONTESTANT", 5))
+        )
+        # One dispatcher worker per judging slot of the fleet, never fewer than DISPATCH_WORKERS
+        self.num_workers: int = int(os.getenv("DISPATCH_WORKERS", 16))
+        self.target_workers: int = self.num_workers
+        self._workers: set[asyncio.Task] = set()
+        # Testdata version of a problem, part of the verdict cache key
+        self.get_problem_version: Optional[callable] = get_problem_version
+        self.cache = VerdictCache(int(float(os.getenv("VERDICT_CACHE_MB", 16)) * 1024 * 1024))
+        # Hedging: every dispatch earns hedge_budget tokens, a duplicate dispatch costs one
+        self.hedge_budget: float = float(os.getenv("HEDGE_BUDGET", 0.1))
+        self.hedge_min_samples: int = int(os.getenv("HEDGE_MIN_SAMPLES", 20))
+        self.hedge_tokens: float = 0.0
+        self.hedges: int = 0
+        self.hedge_wins: int = 0
+        self.failovers: int = 0
         
+    def start_workers(self):
+        self.__resize_workers__()
+    
+    
+    def __resize_workers__(self):
+        # Surplus workers leave on their own once they are done with their current submission
+        self.target_workers = max(self.num_workers, sum(node.slots for node in self.nodes.values()))
+        while len(self._workers) < self.target_workers:
+            self._workers.add(asyncio.create_task(self.__worker__()))
+        
+    
     def load(self):
+        self.start_workers()
         try:
             with open("sandboxes.txt", "r", encoding="utf-8") as file:
                 for line in file:
                     if not line.startswith("http"):
                         continue
-                    self.add(line.strip())
+                    # Format: <url> [slots]
+                    parts = line.split()
+                    self.add(parts[0], int(parts[1]) if len(parts) > 1 else None)
         except Exception as e:
             logger.error(f"Failed to load sandboxes list: {e}")
             
     
-    def add(self, url: str) -> Optional[UUID]:
+    def add(self, url: str, slots: Optional[int] = None) -> Optional[UUID]:
         if not url.startswith("http"):
             return None
-        node = Sandbox(url)
+        if slots is not None and slots < 1:
+            raise ValueError("Number of slots must be positive")
+        node = Sandbox(url, slots or self.default_slots, fixed_slots=slots is not None, on_change=self.__reindex__)
         self.nodes[node.id] = node
-        logger.info("Added new node %s (%s)", node.id, node.url)
+        self.__resize_workers__()
+        logger.info("Added new node %s (%s) with %d slots", node.id, node.url, node.slots)
         return node.id
     
     
@@ -148,46 +508,194 @@ class SandboxManager:
         result = self.nodes.pop(node_id, None)
         if result:
             result.stop()
+            self.__reindex__(result)
+            self.__resize_workers__()
             logger.info("Removed node %s", node_id)
         return result is not None
     
     
-    async def submit(self, submission: Submission, callback: callable):
-        list_nodes = []
-        for node in self.nodes.values():
-            if not node.ready:
-                pass
-            if submission.problem not in node.supported_problems:
-                pass
-            if submission.language not in node.supported_modules:
-                pass
-            list_nodes.append(node)
-        if not list_nodes:
-            submission.status = SubmissionStatus.INTERNAL_ERROR
-            logger.error("No available nodes to process submission %s", submission.id)
-        list_nodes.sort(key=lambda x: x.in_queue)
-        for node in list_nodes:
+    def __reindex__(self, node: Sandbox):
+        if node.id in self.nodes:
+            # The node may report a new number of slots
+            self.__resize_workers__()
+        was_indexed = node.id in self._indexed
+        old_problems, old_modules = self._indexed.pop(node.id, (frozenset(), frozenset()))
+        problems: frozenset[str] = frozenset()
+        modules: frozenset[str] = frozenset()
+        # Nodes with an open breaker stay indexed and are skipped when dispatching, so a node that flaps
+        # is not synced again every time it comes back
+        if node.ready and node.id in self.nodes:
+            problems, modules = frozenset(node.supported_problems), frozenset(node.supported_modules)
+            self._indexed[node.id] = (problems, modules)
+            if not was_indexed and self.on_node_ready:
+                self.on_node_ready(node)
+        
+        # Only touch the keys that actually changed
+        for problem in old_problems:
+            for module in old_modules:
+                if problem in problems and module in modules:
+                    continue
+                nodes = self.index.get((problem, module), None)
+                if nodes is None:
+                    continue
+                nodes.discard(node)
+                if not nodes:
+                    del self.index[(problem, module)]
+        for problem in problems:
+            for module in modules:
+                if problem in old_problems and module in old_modules:
+                    continue
+                self.index.setdefault((problem, module), set()).add(node)
+        
+        for counter, old, new in ((self.problems, old_problems, problems), (self.languages, old_modules, modules)):
+            for key in old - new:
+                counter[key] -= 1
+                if counter[key] == 0:
+                    del counter[key]
+            for key in new - old:
+                counter[key] = counter.get(key, 0) + 1
+        
+    
+    def enqueue(self, submission: Submission, callback: callable, progress: Optional[callable] = None):
+        # Raises QueueFullError when the submission can not be accepted
+        self.queue.put(QueueItem(submission, callback, progress))
+        
+    
+    async def __worker__(self):
+        while len(self._workers) <= self.target_workers:
+            item = await self.queue.get()
+            try:
+                await self.submit(item.submission, item.callback, item.progress)
+            except Exception as e:
+                logger.error(f"Failed to dispatch submission {item.submission.id}: {e}")
+        self._workers.discard(asyncio.current_task())
+        
+    
+    def __cache_key__(self, submission: Submission) -> Optional[tuple]:
+        if not self.cache.enabled:
+            return None
+        version = self.get_problem_version(submission.problem) if self.get_problem_version else ""
+        if version is None:
+            return None
+        return VerdictCache.key(submission, version)
+    
+    
+    async def submit(self, submission: Submission, callback: callable, progress: Optional[callable] = None):
+        key = self.__cache_key__(submission)
+        future: Optional[asyncio.Future] = None
+        if key is not None:
+            verdict = self.cache.get(key)
+            if verdict is None and key in self.cache.in_flight:
+                # An identical submission is being judged, share its verdict without holding a worker
+                self.cache.shared += 1
+                # Taken now, the owner may finish and drop the key before the task first runs
+                asyncio.create_task(self.__share__(submission, self.cache.in_flight[key], callback, progress))
+                return
+            if verdict is not None:
+                submission.status, submission.message = verdict
+                logger.info("Submission %s served from the verdict cache. Status: %s", submission.id, submission.status.name)
+                await callback(submission)
+                return
+            if key not in self.cache.in_flight:
+                future = asyncio.get_running_loop().create_future()
+                self.cache.in_flight[key] = future
+        
+        try:
+            await self.__dispatch__(submission, progress)
+        finally:
+            if future is not None:
+                del self.cache.in_flight[key]
+                self.cache.put(key, submission.status, submission.message)
+                judged = submission.status not in (SubmissionStatus.PENDING, SubmissionStatus.INTERNAL_ERROR)
+                future.set_result((submission.status, submission.message) if judged else None)
+        await callback(submission)
+        
+    
+    async def __share__(self, submission: Submission, owner: asyncio.Future, callback: callable, progress: Optional[callable]):
+        verdict = await asyncio.shield(owner)
+        if verdict is None:
+            # The first one was not judged, try again on its own
+            await self.submit(submission, callback, progress)
+            return
+        submission.status, submission.message = verdict
+        logger.info("Submission %s shared the verdict of an identical one. Status: %s", submission.id, submission.status.name)
+        await callback(submission)
+        
+    
+    async def __dispatch__(self, submission: Submission, progress: Optional[callable] = None):
+        list_nodes = sorted(self.index.get((submission.problem, submission.language), ()), key=lambda x: x.load)
+        attempted = False
+        while list_nodes:
+            node = list_nodes.pop(0)
+            if not node.admit():
+                continue
+            attempted = True
             submission.status = SubmissionStatus.PENDING
             logger.info("Submitting submission %s to node %s", submission.id, node.id)
-            await node.submit(submission)
+            await self.__attempt__(node, submission, list_nodes, progress)
             if submission.status is not SubmissionStatus.INTERNAL_ERROR:
-                await callback(submission)
                 return
+            if list_nodes:
+                self.failovers += 1
             
+        submission.status = SubmissionStatus.INTERNAL_ERROR
+        if not attempted:
+            logger.error("No available nodes to process submission %s", submission.id)
+            return
         logger.error("Submission %s failed on all node", submission.id)
-        await callback(submission)
+        
+    
+    async def __attempt__(self, node: Sandbox, submission: Submission, spare: list[Sandbox], progress: Optional[callable]):
+        self.hedge_tokens = min(10.0, self.hedge_tokens + self.hedge_budget)
+        delay = node.latency_p95(self.hedge_min_samples)
+        if delay is None or not spare or self.hedge_budget <= 0:
+            await node.submit(submission, progress)
+            return
+        
+        acquired = asyncio.get_running_loop().create_future()
+        primary = asyncio.create_task(node.submit(submission, progress, acquired))
+        # The delay is compared to judging times, waiting for a slot of the node does not count
+        await asyncio.wait({primary, acquired}, return_when=asyncio.FIRST_COMPLETED)
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        # A duplicate only helps on a node that can start it right away. While submissions are waiting
+        # in the queue the fleet is busy, the slot is theirs
+        backup_node = None
+        if self.queue.size == 0:
+            backup_node = next((n for n in spare if n.available and n.idle_slot), None)
+        if done or self.hedge_tokens < 1 or backup_node is None:
+            await primary
+            return
+        
+        # Slower than 95% of the recent runs on this node, race a duplicate on an idle node
+        self.hedge_tokens -= 1
+        self.hedges += 1
+        spare.remove(backup_node)
+        shadow = Submission(submission.contestant_id, submission.problem, submission.language, submission.time, submission.code)
+        logger.info("Hedging submission %s to node %s after %.2fs", submission.id, backup_node.id, delay)
+        backup = asyncio.create_task(backup_node.submit(shadow))
+        pending = {primary, backup}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = submission if task is primary else shadow
+                    if result.status is SubmissionStatus.INTERNAL_ERROR:
+                        continue
+                    if task is backup:
+                        self.hedge_wins += 1
+                        submission.status = shadow.status
+                        submission.message = shadow.message
+                    return
+            submission.status = SubmissionStatus.INTERNAL_ERROR
+        finally:
+            for task in pending:
+                task.cancel()
         
         
     def get_supported_languages(self) -> list[str]:
-        result = set()
-        for node in self.nodes.values():
-            result.update(node.supported_modules)
-        return list(result)
+        return list(self.languages)
     
     
     def get_supported_problems(self) -> list[str]:
-        result = set()
-        for node in self.nodes.values():
-            result.update(node.supported_problems)
-        return list(result)
+        return list(self.problems)
     
\ No newline at end of file
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import os
+from typing import Optional
+
+from utils.enums import SubmissionStatus, Topic
+
+logger = logging.getLogger(__name__)
+
+COALESCED_EVENTS = ("SUBMISSION_RESULT", "CONTESTANT_FINISHED")
+
+
+# Merges the scoreboard updates of a tick into one SCOREBOARD_DELTA message:
+#   {"event": "SCOREBOARD_DELTA", "contestants": {"<uid>": {"score": 3, "rank": 1, "progress": {"a": "ACCEPTED"}, "finished": true}}}
+# Only the contestants changed during the tick are included, with their rank at the end of the tick.
+# The tick starts with the first change, so no update waits longer than the window
+class ScoreboardCoalescer:
+    def __init__(self, broadcast: callable, rank: Optional[callable] = None):
+        self.broadcast: callable = broadcast
+        self.rank: Optional[callable] = rank
+        self.window: float = int(os.getenv("SCOREBOARD_TICK_MS", 150)) / 1000
+        self.pending: dict[str, dict] = {}
+        self.received: int = 0
+        self.ticks: int = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+    
+    
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+    
+    
+    def add(self, message: dict) -> bool:
+        # Returns False when the message is not a scoreboard update and should be sent as it is
+        if not self.enabled or message.get("event", None) not in COALESCED_EVENTS:
+            return False
+        self.received += 1
+        if message["event"] == "SUBMISSION_RESULT":
+            entry = self.pending.setdefault(message["contestant"], {"progress": {}})
+            # An accepted problem stays accepted, like on the rankboard
+            if entry["progress"].get(message["problem"], None) != SubmissionStatus.ACCEPTED.name:
+                entry["progress"][message["problem"]] = message["status"]
+        else:
+            entry = self.pending.setdefault(message["uid"], {"progress": {}})
+            entry["finished"] = True
+        entry["score"] = message["score"]
+        if "rank" in message:
+            entry["rank"] = message["rank"]
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        return True
+    
+    
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.pending:
+            return
+        contestants, self.pending = self.pending, {}
+        if self.rank is not None:
+            for uid, entry in contestants.items():
+                entry["rank"] = self.rank(uid)
+        self.ticks += 1
+        self.broadcast({"event": "SCOREBOARD_DELTA", "contestants": contestants}, Topic.SCOREBOARD)
+
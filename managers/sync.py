@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import zlib
+from typing import Optional
+from urllib.parse import quote
+from uuid import UUID
+
+from managers.problems import ProblemManager
+from managers.sandbox import Sandbox
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+# Pushes problem testdata to the nodes advertising "sync" on /capabilities:
+#   GET    /sync/<problem>/manifest       -> {"<relative path>": "<sha256>", ...} (404 when unknown)
+#   PUT    /sync/<problem>/files/<path>   gzip body, X-Content-SHA256 header
+#   DELETE /sync/<problem>/files/<path>
+#   POST   /sync/<problem>/commit         JSON manifest, the node starts serving the problem
+# Only the files whose hash differs from the node's copy are sent
+class TestdataSync:
+    def __init__(self, problem_manager: ProblemManager):
+        self.problem_manager: ProblemManager = problem_manager
+        self.file_concurrency: int = int(os.getenv("SYNC_FILE_CONCURRENCY", 4))
+        # Problems checked at the same time on one node, a fresh node gets the whole archive
+        self.problem_concurrency: int = int(os.getenv("SYNC_PROBLEM_CONCURRENCY", 16))
+        self.files_sent: int = 0
+        self.bytes_sent: int = 0
+        self._nodes = asyncio.Semaphore(int(os.getenv("SYNC_CONCURRENCY", 4)))
+        self._tasks: dict[UUID, asyncio.Task] = {}
+        # path -> (size, mtime, sha256), so unchanged files are never hashed twice
+        self._hashes: dict[str, tuple[int, int, str]] = {}
+    
+    
+    def __hash_file__(self, path: str) -> str:
+        stat = os.stat(path)
+        cached = self._hashes.get(path, None)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            while chunk := file.read(CHUNK_SIZE):
+                digest.update(chunk)
+        self._hashes[path] = (stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+        return digest.hexdigest()
+    
+    
+    def manifest(self, name: str) -> dict[str, str]:
+        # Testdata only, the statement is served by the coordinator itself
+        root = f"problems/{name}"
+        files = ["config.cfg"]
+        if os.path.isdir(f"{root}/testcases"):
+            files.extend(f"testcases/{entry.name}" for entry in os.scandir(f"{root}/testcases") if entry.is_file())
+        return {file: self.__hash_file__(f"{root}/{file}") for file in files if os.path.isfile(f"{root}/{file}")}
+    
+    
+    def schedule(self, node: Sandbox, problems: Optional[list[str]] = None):
+        if not node.capabilities.get("sync", False):
+            return
+        previous = self._tasks.get(node.id, None)
+        task = asyncio.create_task(self.__sync_node__(node, problems, previous))
+        self._tasks[node.id] = task
+        task.add_done_callback(lambda t: self._tasks.pop(node.id, None) if self._tasks.get(node.id) is t else None)
+    
+    
+    async def __sync_node__(self, node: Sandbox, problems: Optional[list[str]], previous: Optional[asyncio.Task]):
+        if previous:
+            # One sync per node at a time, later requests run after the current one
+            await asyncio.gather(previous, return_exceptions=True)
+        async with self._nodes:
+            started = time.monotonic()
+            semaphore = asyncio.Semaphore(self.problem_concurrency)
+            
+            async def sync(name: str) -> int:
+                async with semaphore:
+                    try:
+                        return await self.__sync_problem__(node, name)
+                    except Exception as e:
+                        logger.error(f"Failed to sync problem {name} to sandbox {node.id}: {e or type(e).__name__}")
+                        return 0
+            
+            files = sum(await asyncio.gather(*(sync(name) for name in problems or list(self.problem_manager.problems))))
+            if files:
+                logger.info(f"Synced {files} files to sandbox {node.id} in {time.monotonic() - started:.1f}s")
+                node.wake()
+    
+    
+    async def __sync_problem__(self, node: Sandbox, name: str) -> int:
+        local = await asyncio.to_thread(self.manifest, name)
+        if not local:
+            return 0
+        base = f"/sync/{quote(name, safe='')}"
+        async with node.session.get(f"{base}/manifest", timeout=node.probe_timeout) as resp:
+            if resp.status == 404:
+                remote = {}
+            elif resp.status == 200:
+                remote = await resp.json()
+            else:
+                raise ValueError(f"Response {resp.status} from sandbox")
+        if not isinstance(remote, dict):
+            raise ValueError("Response does not match the expected format")
+        
+        changed = [path for path, digest in local.items() if remote.get(path, None) != digest]
+        removed = [path for path in remote if path not in local]
+        if not changed and not removed:
+            return 0
+        
+        semaphore = asyncio.Semaphore(self.file_concurrency)
+        
+        async def upload(path: str):
+            async with semaphore:
+                await self.__upload__(node, name, path, local[path])
+        
+        async def delete(path: str):
+            async with semaphore:
+                async with node.session.delete(f"{base}/files/{quote(path)}", timeout=node.probe_timeout) as resp:
+                    if resp.status not in (200, 204, 404):
+                        raise ValueError(f"Response {resp.status} from sandbox")
+        
+        await asyncio.gather(*(upload(path) for path in changed), *(delete(path) for path in removed))
+        async with node.session.post(f"{base}/commit", json=local) as resp:
+            if resp.status not in (200, 204):
+                raise ValueError(f"Response {resp.status} from sandbox")
+        return len(changed) + len(removed)
+    
+    
+    async def __upload__(self, node: Sandbox, name: str, path: str, digest: str):
+        def read(file, compressor) -> tuple[bytes, bool]:
+            data = file.read(CHUNK_SIZE)
+            return (compressor.compress(data), False) if data else (compressor.flush(), True)
+        
+        async def body():
+            # Read and compress off the event loop, one chunk at a time
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            with open(f"problems/{name}/{path}", "rb") as file:
+                while True:
+                    chunk, last = await asyncio.to_thread(read, file, compressor)
+                    if chunk:
+                        self.bytes_sent += len(chunk)
+                        yield chunk
+                    if last:
+                        break
+        
+        async with node.session.put(
+            f"/sync/{quote(name, safe='')}/files/{quote(path)}",
+            data=body(),
+            headers={"Content-Encoding": "gzip", "X-Content-SHA256": digest},
+            timeout=node.stream_timeout
+        ) as resp:
+            if resp.status not in (200, 201, 204):
+                raise ValueError(f"Response {resp.status} from sandbox")
+        self.files_sent += 1
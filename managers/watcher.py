@@ -0,0 +1,224 @@
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import time
+from typing import Optional
+
+from managers.problems import ProblemManager
+
+logger = logging.getLogger(__name__)
+
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+# struct inotify_event {int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[];}
+EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd: int = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+    
+    
+    def add(self, path: str) -> int:
+        wd = self._add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+    
+    
+    def read(self) -> list[tuple[int, int, str]]:
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+            offset += length
+            events.append((wd, mask, name))
+        return events
+    
+    
+    def close(self):
+        os.close(self.fd)
+
+
+# Keeps ProblemManager in sync with the problems directory. With inotify (Linux) every problem directory
+# and its testcases are watched and only the problems touched are scanned again, elsewhere the whole
+# directory is polled. Changes are debounced, copying a problem in reloads it once
+class ProblemWatcher:
+    def __init__(self, manager: ProblemManager):
+        self.manager: ProblemManager = manager
+        # auto | inotify | poll | off
+        self.mode: str = os.getenv("PROBLEM_WATCH", "auto")
+        self.poll_interval: float = float(os.getenv("PROBLEM_POLL_INTERVAL", 5))
+        self.debounce: float = 0.2
+        # Called with the name and "added", "updated" or "removed"
+        self.on_change: Optional[callable] = None
+        self.backend: Optional[str] = None
+        self.reloads: int = 0
+        self._inotify: Optional[Inotify] = None
+        # watch descriptor -> problem, None for the problems directory itself
+        self._watches: dict[int, Optional[str]] = {}
+        self._dirty: set[str] = set()
+        self._broken: set[str] = set()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._task: Optional[asyncio.Task] = None
+        # Reloads run one at a time, so an older scan never overwrites a newer one
+        self._lock = asyncio.Lock()
+    
+    
+    def start(self):
+        if self.mode == "off":
+            return
+        if self.mode in ("auto", "inotify"):
+            try:
+                self.__start_inotify__()
+                self.backend = "inotify"
+                logger.info(f"Watching {len(self._watches)} problem directories with inotify")
+                return
+            except Exception as e:
+                logger.warning(f"Cannot watch the problems with inotify ({e}), polling every {self.poll_interval}s")
+        self.backend = "poll"
+        self._task = asyncio.create_task(self.__poll__())
+    
+    
+    def __start_inotify__(self):
+        self._inotify = Inotify()
+        try:
+            self._watches[self._inotify.add("problems")] = None
+            for entry in os.scandir("problems"):
+                if entry.is_dir() and not entry.name.startswith("."):
+                    self.__watch_problem__(entry.name)
+        except Exception:
+            self._inotify.close()
+            self._inotify = None
+            self._watches.clear()
+            raise
+        asyncio.get_running_loop().add_reader(self._inotify.fd, self.__read__)
+    
+    
+    def __watch_problem__(self, name: str):
+        for path in (f"problems/{name}", f"problems/{name}/testcases"):
+            if os.path.isdir(path):
+                self._watches[self._inotify.add(path)] = name
+    
+    
+    def __read__(self):
+        for wd, mask, name in self._inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, check every problem
+                self._dirty.update(self.__names__())
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if wd not in self._watches:
+                continue
+            problem = self._watches[wd]
+            created = mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO)
+            if problem is None:
+                if name.startswith("."):
+                    continue
+                problem = name
+                if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                    # Renamed away, the watches come back under the new name with the same descriptors
+                    self._watches = {w: p for w, p in self._watches.items() if p != name}
+                if created:
+                    self.__try_watch__(problem)
+            elif created and name == "testcases":
+                self.__try_watch__(problem)
+            self._dirty.add(problem)
+        if self._dirty and self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.debounce, self.__flush__)
+    
+    
+    def __try_watch__(self, name: str):
+        try:
+            self.__watch_problem__(name)
+        except OSError as e:
+            logger.error(f"Cannot watch problem {name}: {e}")
+    
+    
+    def __flush__(self):
+        self._timer = None
+        names, self._dirty = self._dirty, set()
+        asyncio.create_task(self.__reload__(names))
+    
+    
+    @staticmethod
+    def __names__() -> set[str]:
+        return {entry.name for entry in os.scandir("problems") if entry.is_dir() and not entry.name.startswith(".")}
+    
+    
+    def __scan_all__(self, names: set[str]) -> dict[str, object]:
+        # Runs in a thread, a failed scan is returned as its exception
+        results = {}
+        for name in names:
+            try:
+                results[name] = self.manager.scan(name)
+            except Exception as e:
+                results[name] = e
+        return results
+    
+    
+    async def __reload__(self, names: set[str]):
+        async with self._lock:
+            started = time.monotonic()
+            results = await asyncio.to_thread(self.__scan_all__, names)
+            self.__apply__(results, started)
+    
+    
+    def __apply__(self, results: dict[str, object], started: float):
+        for name, result in results.items():
+            if isinstance(result, Exception):
+                # A half copied problem is retired until it is complete
+                if name not in self._broken:
+                    logger.error(f"Failed to reload problem {name}: {result}")
+                self._broken.add(name)
+                result = None
+            else:
+                self._broken.discard(name)
+            state = self.manager.update(name, result)
+            if state is None:
+                continue
+            self.reloads += 1
+            logger.info(f"Problem {name} {state} in {(time.monotonic() - started) * 1000:.0f}ms")
+            if self.on_change:
+                self.on_change(name, state)
+    
+    
+    async def __poll__(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.rescan()
+            except Exception as e:
+                logger.error(f"Failed to poll the problems: {e}")
+    
+    
+    async def rescan(self):
+        await self.__reload__(self.__names__() | set(self.manager.problems))
@@ -0,0 +1,164 @@
+"""
+Dispatch benchmark: starts a fleet of fake sandboxes in-process,
+registers them with a SandboxManager and pushes submissions through the
+real queue, routing, hedging and failover code, then reports throughput,
+verdict latency percentiles and failover counts.
+
+Usage: python -m tools.benchmark --nodes 4 --slots 4 --submissions 2000 --latency lognormal:0.2,0.5
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import time
+from uuid import uuid4
+
+from managers.data import Submission
+from managers.queue import QueueFullError
+from managers.sandbox import SandboxManager
+from tools.fake_sandbox import DEFAULT_VERDICTS, FakeSandbox
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run(args: argparse.Namespace) -> dict:
+    problems = [f"p{i}" for i in range(args.problems)]
+    languages = ["c", "cpp", "python"]
+    fleet: list[FakeSandbox] = []
+    for i in range(args.nodes):
+        sandbox = FakeSandbox(
+            slots=args.slots, latency=args.latency, verdicts=args.verdicts,
+            failure_rate=args.failure_rate if i < args.faulty_nodes else 0.0,
+            hang_rate=args.hang_rate if i < args.faulty_nodes else 0.0,
+            problems=problems, modules=languages, jobs=args.jobs, batch=args.batch
+        )
+        await sandbox.start("127.0.0.1", args.base_port + i)
+        fleet.append(sandbox)
+    
+    manager = SandboxManager()
+    manager.num_workers = args.workers
+    manager.queue.max_size = args.queue_size
+    manager.queue.max_per_contestant = args.queue_size
+    if args.no_cache:
+        manager.cache.max_bytes = 0
+    manager.start_workers()
+    for i in range(args.nodes):
+        manager.add(f"http://127.0.0.1:{args.base_port + i}")
+    
+    # Wait for every node to pass its first health probe
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and not all(node.ready for node in manager.nodes.values()):
+        await asyncio.sleep(0.05)
+    
+    latencies: list[float] = []
+    verdicts: dict[str, int] = {}
+    rejected = 0
+    remaining = args.submissions
+    finished = asyncio.Event()
+    started_at: dict = {}
+    contestants = [uuid4() for _ in range(args.contestants)]
+    
+    async def callback(submission: Submission):
+        nonlocal remaining
+        latencies.append(time.monotonic() - started_at.pop(submission.id))
+        verdicts[submission.status.name] = verdicts.get(submission.status.name, 0) + 1
+        remaining -= 1
+        if remaining == 0:
+            finished.set()
+    
+    start = time.monotonic()
+    for i in range(args.submissions):
+        duplicate = random.random() < args.duplicates
+        submission = Submission(
+            contestant_id=random.choice(contestants),
+            problem=random.choice(problems),
+            language=random.choice(languages),
+            time=int(time.monotonic() - start),
+            code=b"duplicate" if duplicate else f"int main() {{ return {i}; }}".encode()
+        )
+        while True:
+            try:
+                started_at[submission.id] = time.monotonic()
+                manager.enqueue(submission, callback)
+                break
+            except QueueFullError as e:
+                rejected += 1
+                await asyncio.sleep(min(e.retry_after, 0.05))
+        if args.rate > 0:
+            await asyncio.sleep(1 / args.rate)
+    await finished.wait()
+    elapsed = time.monotonic() - start
+    
+    for node in list(manager.nodes):
+        manager.remove(node)
+    # Let the node sessions close before the loop goes away
+    await asyncio.sleep(0.25)
+    for sandbox in fleet:
+        await sandbox.stop()
+    
+    return {
+        "submissions": args.submissions,
+        "elapsed": elapsed,
+        "throughput": args.submissions / elapsed,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "max": max(latencies, default=0.0),
+        "verdicts": verdicts,
+        "rejected": rejected,
+        "failovers": manager.failovers,
+        "hedges": manager.hedges,
+        "hedge_wins": manager.hedge_wins,
+        "batches": sum(sandbox.batches for sandbox in fleet),
+        "cache_hits": manager.cache.hits,
+        "cache_shared": manager.cache.shared,
+        "max_queue_wait": manager.queue.max_wait
+    }
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Coordinator dispatch benchmark")
+    parser.add_argument("--nodes", type=int, default=4)
+    parser.add_argument("--slots", type=int, default=4, help="judging slots per node")
+    parser.add_argument("--submissions", type=int, default=1000)
+    parser.add_argument("--contestants", type=int, default=100)
+    parser.add_argument("--problems", type=int, default=3)
+    parser.add_argument("--rate", type=float, default=0, help="submissions per second, 0 sends a single burst")
+    parser.add_argument("--latency", default="lognormal:0.1,0.5")
+    parser.add_argument("--verdicts", default=DEFAULT_VERDICTS)
+    parser.add_argument("--faulty-nodes", type=int, default=0, help="nodes affected by failure/hang rates")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--hang-rate", type=float, default=0.0)
+    parser.add_argument("--duplicates", type=float, default=0.0, help="fraction of byte-identical submissions")
+    parser.add_argument("--jobs", action="store_true", help="use the streaming job protocol")
+    parser.add_argument("--batch", type=int, default=0, help="let the nodes accept batches of up to N submissions")
+    parser.add_argument("--workers", type=int, default=16, help="minimum dispatcher workers, the pool grows with the slots")
+    parser.add_argument("--queue-size", type=int, default=100000)
+    parser.add_argument("--no-cache", action="store_true", help="disable the verdict cache")
+    parser.add_argument("--base-port", type=int, default=19000)
+    parser.add_argument("--log-level", default="ERROR")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    logging.basicConfig(level=args.log_level)
+    result = asyncio.run(run(args))
+    print(f"Submissions: {result['submissions']} in {result['elapsed']:.2f}s ({result['throughput']:.1f}/s)")
+    print(f"Verdict latency: p50 {result['p50'] * 1000:.0f}ms - p95 {result['p95'] * 1000:.0f}ms"
+          f" - p99 {result['p99'] * 1000:.0f}ms - max {result['max'] * 1000:.0f}ms")
+    print(f"Max queue wait: {result['max_queue_wait'] * 1000:.0f}ms - Rejected (retried): {result['rejected']}")
+    print(f"Failovers: {result['failovers']} - Hedges: {result['hedges']} (won: {result['hedge_wins']})"
+          f" - Cache hits: {result['cache_hits']} - Shared runs: {result['cache_shared']}"
+          f" - Batch requests: {result['batches']}")
+    print("Verdicts: " + ", ".join(f"{name}: {count}" for name, count in sorted(result["verdicts"].items())))
+
+
+if __name__ == "__main__":
+    main()
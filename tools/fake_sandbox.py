@@ -0,0 +1,295 @@
+"""
+Local stand-in for a judge node, speaking the same HTTP protocol as the
+real sandbox (/version, /modules, /problems, /capabilities, /submit and
+the streaming /jobs API, /submit/batch and the /sync testdata API). Verdicts are drawn at random, judging time
+follows a configurable distribution and failures can be injected, so
+the coordinator can be exercised without real judge machines.
+
+Usage: python -m tools.fake_sandbox --port 9000 --slots 4 --latency lognormal:0.5,0.4
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+from typing import Optional
+from uuid import uuid4
+
+from aiohttp import web
+
+DEFAULT_VERDICTS = "ACCEPTED=0.5,WRONG_ANSWER=0.3,TIME_LIMIT_EXCEEDED=0.1,RUNTIME_ERROR=0.05,COMPILATION_ERROR=0.05"
+
+
+def parse_latency(spec: str) -> callable:
+    # fixed:<s> | uniform:<min>,<max> | lognormal:<median>,<sigma> | exponential:<mean>
+    kind, _, params = spec.partition(":")
+    values = [float(x) for x in params.split(",") if x]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal":
+        mu = math.log(values[0])
+        return lambda: random.lognormvariate(mu, values[1])
+    if kind == "exponential":
+        return lambda: random.expovariate(1 / values[0])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def parse_verdicts(spec: str) -> tuple[list[str], list[float]]:
+    names, weights = [], []
+    for item in spec.split(","):
+        name, _, weight = item.partition("=")
+        names.append(name.strip().upper())
+        weights.append(float(weight))
+    return names, weights
+
+
+class FakeSandbox:
+    def __init__(self, slots: int = 1, latency: str = "fixed:0.1", verdicts: str = DEFAULT_VERDICTS,
+                 failure_rate: float = 0.0, hang_rate: float = 0.0, problems: Optional[list[str]] = None,
+                 modules: Optional[list[str]] = None, jobs: bool = False, testcases: int = 10,
+                 advertise: bool = True, batch: int = 0, sync: bool = False):
+        self.slots: int = slots
+        self.latency: callable = parse_latency(latency)
+        self.verdicts, self.weights = parse_verdicts(verdicts)
+        self.failure_rate: float = failure_rate
+        self.hang_rate: float = hang_rate
+        self.problems: list[str] = problems or ["a", "b", "c"]
+        self.modules: list[str] = modules or ["c", "cpp", "python"]
+        self.jobs: bool = jobs
+        self.testcases: int = testcases
+        self.advertise: bool = advertise
+        self.batch: int = batch
+        self.batches: int = 0
+        self.sync: bool = sync
+        # problem -> {relative path: sha256} of the testdata received through /sync
+        self.files: dict[str, dict[str, str]] = {}
+        self.judged: int = 0
+        self.failed: int = 0
+        self._semaphore = asyncio.Semaphore(slots)
+        self._jobs: dict[str, dict] = {}
+        self._runner: Optional[web.AppRunner] = None
+        
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.add_routes([
+            web.get("/version", self.version),
+            web.get("/modules", self.get_modules),
+            web.get("/problems", self.get_problems),
+            web.get("/capabilities", self.capabilities),
+            web.post("/submit", self.submit),
+            web.post("/submit/batch", self.submit_batch),
+            web.post("/jobs", self.create_job),
+            web.get("/jobs/{job_id}/events", self.job_events),
+            web.delete("/jobs/{job_id}", self.cancel_job),
+            web.get("/sync/{problem}/manifest", self.sync_manifest),
+            web.put("/sync/{problem}/files/{path:.+}", self.sync_upload),
+            web.delete("/sync/{problem}/files/{path:.+}", self.sync_delete),
+            web.post("/sync/{problem}/commit", self.sync_commit)
+        ])
+    
+    
+    async def start(self, host: str, port: int):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+    
+    
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+    
+    
+    async def version(self, request: web.Request):
+        return web.Response(text="fake-sandbox-1.0")
+    
+    
+    async def get_modules(self, request: web.Request):
+        return web.json_response(self.modules)
+    
+    
+    async def get_problems(self, request: web.Request):
+        return web.json_response(self.problems)
+    
+    
+    async def capabilities(self, request: web.Request):
+        if not self.advertise:
+            raise web.HTTPNotFound()
+        return web.json_response({"slots": self.slots, "jobs": self.jobs, "batch": self.batch, "sync": self.sync})
+    
+    
+    async def __judge__(self, events: Optional[asyncio.Queue] = None) -> Optional[str]:
+        # Returns the verdict, or None when the node should fail the request.
+        # With an event queue the run is reported testcase by testcase
+        async with self._semaphore:
+            if random.random() < self.hang_rate:
+                await asyncio.sleep(3600)
+            verdict = random.choices(self.verdicts, self.weights)[0]
+            failed = random.random() < self.failure_rate
+            duration = self.latency()
+            if events is None or failed:
+                await asyncio.sleep(duration)
+            else:
+                failing = random.randint(1, self.testcases) if verdict != "ACCEPTED" else None
+                for index in range(1, self.testcases + 1):
+                    await asyncio.sleep(duration / self.testcases)
+                    status = verdict if index == failing else "ACCEPTED"
+                    events.put_nowait({"type": "testcase", "index": index, "total": self.testcases, "status": status})
+                    if index == failing:
+                        break
+            if failed:
+                self.failed += 1
+                verdict = None
+            else:
+                self.judged += 1
+            if events is not None:
+                events.put_nowait({"type": "result", "status": verdict} if verdict else None)
+            return verdict
+    
+    
+    async def __read_form__(self, request: web.Request) -> dict:
+        data = await request.post()
+        if data.get("problem_id", None) not in self.problems or data.get("target_module", None) not in self.modules:
+            raise web.HTTPBadRequest(text="Unsupported problem or module")
+        return data
+    
+    
+    async def submit(self, request: web.Request):
+        await self.__read_form__(request)
+        verdict = await self.__judge__()
+        if verdict is None:
+            raise web.HTTPInternalServerError(text="Injected failure")
+        return web.json_response({"status": verdict, "message": None})
+    
+    
+    async def submit_batch(self, request: web.Request):
+        if not self.batch:
+            raise web.HTTPNotFound()
+        data = await request.post()
+        ids = data.getall("id", [])
+        if len(ids) > self.batch:
+            raise web.HTTPBadRequest(text="Batch too large")
+        self.batches += 1
+        verdicts = await asyncio.gather(*(self.__judge__() for _ in ids))
+        return web.json_response([
+            {"id": item_id, "status": verdict or "INTERNAL_ERROR", "message": None if verdict else "Injected failure"}
+            for item_id, verdict in zip(ids, verdicts)
+        ])
+    
+    
+    async def create_job(self, request: web.Request):
+        if not self.jobs:
+            raise web.HTTPNotFound()
+        await self.__read_form__(request)
+        job_id = uuid4().hex
+        events = asyncio.Queue()
+        self._jobs[job_id] = {"events": events, "task": asyncio.create_task(self.__judge__(events))}
+        return web.json_response({"job_id": job_id}, status=202)
+    
+    
+    async def job_events(self, request: web.Request):
+        job = self._jobs.get(request.match_info["job_id"], None)
+        if job is None:
+            raise web.HTTPNotFound()
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        try:
+            while True:
+                event = await job["events"].get()
+                if event is None:
+                    # Injected failure, end the stream without a result
+                    break
+                await response.write((json.dumps(event) + "\n").encode())
+                if event["type"] == "result":
+                    break
+        finally:
+            self._jobs.pop(request.match_info["job_id"], None)
+        return response
+    
+    
+    async def cancel_job(self, request: web.Request):
+        job = self._jobs.pop(request.match_info["job_id"], None)
+        if job is not None:
+            job["task"].cancel()
+        return web.Response(status=204)
+    
+    
+    async def sync_manifest(self, request: web.Request):
+        files = self.files.get(request.match_info["problem"], None)
+        if not self.sync or files is None:
+            raise web.HTTPNotFound()
+        return web.json_response(files)
+    
+    
+    async def sync_upload(self, request: web.Request):
+        if not self.sync:
+            raise web.HTTPNotFound()
+        # The gzip Content-Encoding is undone by aiohttp before the body gets here
+        digest = hashlib.sha256(await request.read()).hexdigest()
+        if digest != request.headers.get("X-Content-SHA256", digest):
+            raise web.HTTPBadRequest(text="Checksum mismatch")
+        self.files.setdefault(request.match_info["problem"], {})[request.match_info["path"]] = digest
+        return web.Response(status=204)
+    
+    
+    async def sync_delete(self, request: web.Request):
+        self.files.get(request.match_info["problem"], {}).pop(request.match_info["path"], None)
+        return web.Response(status=204)
+    
+    
+    async def sync_commit(self, request: web.Request):
+        problem = request.match_info["problem"]
+        if await request.json() != self.files.get(problem, {}):
+            raise web.HTTPConflict(text="Manifest does not match the received files")
+        if problem not in self.problems:
+            self.problems.append(problem)
+        return web.Response(status=204)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Fake sandbox node for load testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--slots", type=int, default=1, help="concurrent judgements")
+    parser.add_argument("--latency", default="lognormal:0.5,0.4",
+                        help="fixed:<s>, uniform:<min>,<max>, lognormal:<median>,<sigma> or exponential:<mean>")
+    parser.add_argument("--verdicts", default=DEFAULT_VERDICTS, help="weighted verdict mix")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="fraction of requests that never finish")
+    parser.add_argument("--problems", default="a,b,c")
+    parser.add_argument("--modules", default="c,cpp,python")
+    parser.add_argument("--jobs", action="store_true", help="advertise the streaming job protocol")
+    parser.add_argument("--testcases", type=int, default=10)
+    parser.add_argument("--batch", type=int, default=0, help="advertise batch submissions of up to N items")
+    parser.add_argument("--sync", action="store_true", help="accept testdata pushed by the coordinator")
+    parser.add_argument("--no-capabilities", action="store_true", help="behave like an old node without /capabilities")
+    return parser
+
+
+def from_args(args: argparse.Namespace) -> FakeSandbox:
+    return FakeSandbox(
+        slots=args.slots, latency=args.latency, verdicts=args.verdicts, failure_rate=args.failure_rate,
+        hang_rate=args.hang_rate, problems=args.problems.split(","), modules=args.modules.split(","),
+        jobs=args.jobs, testcases=args.testcases, advertise=not args.no_capabilities, batch=args.batch,
+        sync=args.sync
+    )
+
+
+async def main():
+    args = build_parser().parse_args()
+    sandbox = from_args(args)
+    await sandbox.start(args.host, args.port)
+    print(f"Fake sandbox listening on http://{args.host}:{args.port} with {args.slots} slots")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await sandbox.stop()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
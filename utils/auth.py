@@ -1,3 +1,4 @@
+from collections import OrderedDict
 from typing import Optional
 import uuid
 import jwt
@@ -16,3 +17,50 @@ def verify_token(token: Optional[str]) -> Optional[uuid.UUID]:
         return uuid.UUID(decoded["user_id"])
     except:
         return None
+
+
+# Tokens already verified -> user id, so the signature of a known token is checked only once.
+# Only valid tokens are kept, the least recently used one goes first when full
+class TokenCache:
+    def __init__(self, max_size: int):
+        self.max_size: int = max_size
+        self.hits: int = 0
+        self.misses: int = 0
+        self._entries: OrderedDict[str, uuid.UUID] = OrderedDict()
+    
+    
+    def verify(self, token: Optional[str]) -> Optional[uuid.UUID]:
+        if not token:
+            return None
+        user_id = self._entries.get(token, None)
+        if user_id is not None:
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return user_id
+        self.misses += 1
+        user_id = verify_token(token)
+        if user_id is not None and self.max_size > 0:
+            self._entries[token] = user_id
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return user_id
+    
+    
+    def clear(self):
+        self._entries.clear()
+    
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def generate_admin_token() -> str:
+    return jwt.encode({"role": "admin"}, jwt_secret, algorithm="HS256")
+
+
+def verify_admin_token(token: Optional[str]) -> bool:
+    try:
+        decoded = jwt.decode(token, jwt_secret, algorithms=["HS256"])
+        return decoded.get("role", None) == "admin"
+    except:
+        return False
@@ -16,4 +16,10 @@ class ContestProgress(StrEnum):
     NOT_STARTED = auto()
     IN_PROGRESS = auto()
     FINISHED = auto()
+
+
+class Topic(StrEnum):
+    SCOREBOARD = auto()
+    CONTESTANT = auto()
+    ADMIN = auto()
     
\ No newline at end of file
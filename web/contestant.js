@@ -57,7 +57,7 @@ document.addEventListener("DOMContentLoaded", function() {
         return _localStorageItem;
     }
 
-    function updateSubmission(id, problem, lang, result, time) {
+    function updateSubmission(id, problem, lang, result, time, message) {
         // Query for existing submission
         let item = submissionList.querySelector(`[data-id="${id}"]`);
         let _new = false;
@@ -73,6 +73,7 @@ document.addEventListener("DOMContentLoaded", function() {
         let resultField = item.querySelector(".result .status")
         resultField.innerText = result;
         resultField.style.color = getColor(result);
+        if (message) resultField.title = message;
         let min = Math.floor(time / 60);
         let sec = time % 60;
         item.querySelector(".result .time").innerText = (min > 0 ? min + "m" : "") + sec + "s";
@@ -82,6 +83,14 @@ document.addEventListener("DOMContentLoaded", function() {
         }
     }
     
+    function updateSubmissionProgress(id, testcase, total) {
+        let item = submissionList.querySelector(`[data-id="${id}"]`);
+        if (item === null) return;
+        let resultField = item.querySelector(".result .status");
+        if (resultField.innerText !== "PENDING" && !resultField.innerText.startsWith("Test ")) return;
+        resultField.innerText = `Test ${testcase}/${total}`;
+    }
+    
     // Manage contestant cards in top bar and ranking list
     let userId = "";
 
@@ -119,7 +128,7 @@ document.addEventListener("DOMContentLoaded", function() {
         });
     }
 
-    function updateContestantScore(id, score, finished) {
+    function updateContestantScore(id, score, finished, sort = true) {
         let item = rankingList.querySelector(`div[data-id="${id}"]`);
         if (item === null) return;
         item.querySelector(".result div h3").innerText = score;
@@ -128,7 +137,21 @@ document.addEventListener("DOMContentLoaded", function() {
             document.querySelector("#user-card .result div h3").innerText = score;
             finalScore.innerText = score;
         }
+        if (sort) sortRankingList();
+    }
+
+    // One message per tick with the contestants changed since the previous one
+    function applyScoreboardDelta(contestants) {
+        for (const uid in contestants) {
+            let change = contestants[uid];
+            for (const problem in change.progress) {
+                updateContestantProgress(uid, problem, change.progress[problem]);
+            }
+            updateContestantScore(uid, change.score, change.finished === true, false);
+        }
         sortRankingList();
+        // CONTESTANT_FINISHED is folded into the tick, e.g. when every problem is solved
+        if (userId in contestants && contestants[userId].finished === true) endContest();
     }
 
     function updateContestantProgress(id, problem, status) {
@@ -217,6 +240,7 @@ document.addEventListener("DOMContentLoaded", function() {
             }
             localStorage.setItem("Authorization", resp.token);
             userId = resp.uid;
+            subscribePrivate();
             setName(resp.name);
             registerForm.hidden = true;
             document.getElementById("waiting").hidden = false;
@@ -297,12 +321,71 @@ document.addEventListener("DOMContentLoaded", function() {
         submitLanguageSelector.appendChild(option);
     }
 
-    // Websocket connection
-    const ws = new WebSocket("../ws");
-    ws.timeout = 10000;
-    ws.onmessage = function(event) {
-        let data = JSON.parse(event.data);
+    // Compact websocket protocol, the tables are sent by the server in the first message
+    let protocol = null;
+    function decodeMessage(text) {
+        let data = JSON.parse(text);
+        if (data.event === "PROTOCOL") {
+            let keys = {};
+            for (const key in data.keys) keys[data.keys[key]] = key;
+            protocol = {keys: keys, values: {event: data.events, status: data.statuses, contest_progress: data.progresses}};
+            return null;
+        }
+        return protocol === null ? data : expand(data, null);
+    }
+
+    function expand(value, key) {
+        if (Array.isArray(value)) return value.map(item => expand(item, key));
+        if (value !== null && typeof value === "object") {
+            let result = {};
+            for (const k in value) {
+                let name = protocol.keys[k] ?? k;
+                if (name === "progress") {
+                    result[name] = {};
+                    for (const problem in value[k]) result[name][problem] = expand(value[k][problem], "status");
+                }
+                else result[name] = expand(value[k], name);
+            }
+            return result;
+        }
+        if (typeof value === "number" && key in protocol.values) return protocol.values[key][value];
+        return value;
+    }
+
+    // Websocket connection, resumed from the last received event after a disconnect
+    // The verdict details and judging progress only come on the private topic of the contestant
+    let lastSeq = null;
+    let reconnectDelay = 1000;
+    let socket = null;
+    function connect() {
+        let params = new URLSearchParams({topics: "scoreboard", proto: "compact"});
+        if (userId !== "") {
+            params.set("topics", "scoreboard,contestant:" + userId);
+            params.set("token", getToken());
+        }
+        if (lastSeq !== null) params.set("since", lastSeq);
+        const ws = new WebSocket("../ws?" + params.toString());
+        socket = ws;
+        protocol = null;
+        ws.onopen = function() {
+            reconnectDelay = 1000;
+        };
+        ws.onmessage = onEvent;
+        ws.onclose = function() {
+            setTimeout(connect, reconnectDelay * (0.5 + Math.random()));
+            reconnectDelay = Math.min(reconnectDelay * 2, 10000);
+        };
+    }
+
+    function onEvent(event) {
+        let data = decodeMessage(event.data);
+        if (data === null) return;
+        if (data.seq !== undefined) lastSeq = data.seq;
         switch (data.event) {
+            case "SNAPSHOT":
+                // Missed too many events, load the whole state again
+                window.location.reload();
+                break;
             case "CONTEST_STARTED":
                 if (userId === "") {
                     alert("Phiên thi đã bắt đầu, bạn vui lòng đợi phiên thi tiếp theo.");
@@ -327,24 +410,25 @@ document.addEventListener("DOMContentLoaded", function() {
                 updateContestantScore(data.uid, data.score, true);
                 if (data.uid === userId) endContest();
                 break;
+            case "SUBMISSION_PROGRESS":
+                updateSubmissionProgress(data.id, data.testcase, data.total);
+                break;
+            case "SUBMISSION_VERDICT":
+                updateSubmission(data.id, data.problem, data.language, data.status, data.time, data.message);
+                break;
+            case "SCOREBOARD_DELTA":
+                applyScoreboardDelta(data.contestants);
+                break;
             case "SUBMISSION_RESULT":
-                if (data.contestant === userId) updateSubmission(data.id, data.problem, data.language, data.status, data.time);
                 updateContestantProgress(data.contestant, data.problem, data.status);
                 updateContestantScore(data.contestant, data.score, false);
                 break;
         }
     }
-    ws.onclose = function() {
-        alert("Mất kết nối tới máy chủ.");
-        reset();
-    };
-    ws.onerror = function() {
-        alert("Đã xảy ra lỗi khi kết nối tới máy chủ.");
-        reset();
-    };
-    ws.ontimeout = function() {
-        alert("Hết thời gian chờ phản hồi từ máy chủ.");
-        reset();
+
+    function subscribePrivate() {
+        if (socket === null || socket.readyState !== WebSocket.OPEN) return;
+        socket.send(JSON.stringify({action: "subscribe", topics: ["contestant:" + userId], token: getToken()}));
     }
 
     // Start contest
@@ -420,6 +504,7 @@ document.addEventListener("DOMContentLoaded", function() {
             submitBtn.innerHTML = "Nộp bài";
             if (xhr.status !== 200) {
                 alert(`Yêu cầu thất bại (${xhr.status}): ${xhr.responseText}`);
+                return;
             }
             let data = JSON.parse(xhr.responseText);
             if (data.id === undefined || data.problem === undefined || data.language === undefined || data.result === undefined || data.time === undefined) {
@@ -447,6 +532,7 @@ document.addEventListener("DOMContentLoaded", function() {
     function startNormal() {
         registerSection.hidden = false;
         localStorage.clear()
+        connect();
     }
 
     if (getToken() !== "") {
@@ -465,6 +551,7 @@ document.addEventListener("DOMContentLoaded", function() {
                 return;
             }
             userId = data.uid;
+            if (data.seq !== undefined && (lastSeq === null || data.seq > lastSeq)) lastSeq = data.seq;
             setName(data.name)
             if (data.color !== undefined) {
                 document.documentElement.style.setProperty("--theme-color", data.color);
@@ -495,13 +582,14 @@ document.addEventListener("DOMContentLoaded", function() {
                         }
                         updateContestantScore(contestant.uid, contestant.score, contestant.finished > 0);
                     });
-                    startContest(data.contest.duration - data.contest.elapsed)
+                    startContest(data.contest.duration - parseInt(xhr.getResponseHeader("X-Contest-Elapsed") || "0"))
                     break;
                 case "FINISHED":
                     deployContestantList([])
                     endContest();
                     break;
             }
+            connect();
         }
         xhr.onerror = function() {
             startNormal();
@@ -46,12 +46,61 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
 
-    // Websocket connection
-    const ws = new WebSocket("../ws");
-    ws.timeout = 10000;
-    ws.onmessage = function(event) {
-        let data = JSON.parse(event.data);
+    // Compact websocket protocol, the tables are sent by the server in the first message
+    let protocol = null;
+    function decodeMessage(text) {
+        let data = JSON.parse(text);
+        if (data.event === "PROTOCOL") {
+            let keys = {};
+            for (const key in data.keys) keys[data.keys[key]] = key;
+            protocol = {keys: keys, values: {event: data.events, status: data.statuses, contest_progress: data.progresses}};
+            return null;
+        }
+        return protocol === null ? data : expand(data, null);
+    }
+
+    function expand(value, key) {
+        if (Array.isArray(value)) return value.map(item => expand(item, key));
+        if (value !== null && typeof value === "object") {
+            let result = {};
+            for (const k in value) {
+                let name = protocol.keys[k] ?? k;
+                if (name === "progress") {
+                    result[name] = {};
+                    for (const problem in value[k]) result[name][problem] = expand(value[k][problem], "status");
+                }
+                else result[name] = expand(value[k], name);
+            }
+            return result;
+        }
+        if (typeof value === "number" && key in protocol.values) return protocol.values[key][value];
+        return value;
+    }
+
+    // Websocket connection, starts from a snapshot and resumes from the last received event after a disconnect
+    let lastSeq = null;
+    let reconnectDelay = 1000;
+    function connect() {
+        const ws = new WebSocket((lastSeq === null ? "../ws?snapshot=1" : "../ws?since=" + lastSeq) + "&proto=compact");
+        protocol = null;
+        ws.onopen = function() {
+            reconnectDelay = 1000;
+        };
+        ws.onmessage = onEvent;
+        ws.onclose = function() {
+            setTimeout(connect, reconnectDelay * (0.5 + Math.random()));
+            reconnectDelay = Math.min(reconnectDelay * 2, 10000);
+        };
+    }
+
+    function onEvent(event) {
+        let data = decodeMessage(event.data);
+        if (data === null) return;
+        if (data.seq !== undefined) lastSeq = data.seq;
         switch (data.event) {
+            case "SNAPSHOT":
+                deploySnapshot(data);
+                break;
             case "NEW_CONTESTANT":
                 addPreContestant(data.name, data.color);
                 break;
@@ -68,15 +117,33 @@ document.addEventListener('DOMContentLoaded', function() {
             case "CONTESTANT_FINISHED":
                 updateContestantScore(data.uid, data.score, true);
                 break;
+            case "SCOREBOARD_DELTA":
+                applyScoreboardDelta(data.contestants);
+                break;
             case "SUBMISSION_RESULT":
                 updateContestantProgress(data.contestant, data.problem, data.status);
                 updateContestantScore(data.contestant, data.score, false);
                 break;
         }
     }
-    ws.onclose = function() {
-        alert("Kết nối tới máy chủ đã bị đóng.");
-        window.location.reload();
+    connect();
+
+    function deploySnapshot(data) {
+        endTimer();
+        rankingList.innerHTML = "";
+        if (data.contest_progress === "NOT_STARTED") {
+            data.contestants.forEach(contestant => addPreContestant(contestant.name, contestant.color));
+            return;
+        }
+        let problems = data.contest !== undefined ? data.contest.problems : [];
+        deployContestantList(data.contestants, problems);
+        data.contestants.forEach(contestant => {
+            for (const key in contestant.progress) {
+                updateContestantProgress(contestant.uid, key, contestant.progress[key]);
+            }
+            updateContestantScore(contestant.uid, contestant.score, contestant.finished > 0);
+        });
+        if (data.contest !== undefined) startTimer(data.contest.duration - data.elapsed);
     }
 
     let countdownInterval = undefined;
@@ -135,11 +202,23 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
-    function updateContestantScore(id, score, finished) {
+    function updateContestantScore(id, score, finished, sort = true) {
         let item = rankingList.querySelector(`div[data-id="${id}"]`);
         if (item === null) return;
         item.querySelector(".result div h3").innerText = score;
         if (finished) item.querySelector(".description span").hidden = false;
+        if (sort) sortRankingList();
+    }
+
+    // One message per tick with the contestants changed since the previous one
+    function applyScoreboardDelta(contestants) {
+        for (const uid in contestants) {
+            let change = contestants[uid];
+            for (const problem in change.progress) {
+                updateContestantProgress(uid, problem, change.progress[problem]);
+            }
+            updateContestantScore(uid, change.score, change.finished === true, false);
+        }
         sortRankingList();
     }
 